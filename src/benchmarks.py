@@ -0,0 +1,474 @@
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+import argparse
+import json
+import platform
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+import numpy as np
+import news_headlines
+import stock_prices
+import etf_transformations
+from sector_keywords import sector_keywords
+from keyword_matcher import KeywordMatcher
+from news_headlines import clean_headlines, flag_sectors, preprocess_news
+from stock_prices import preprocess_file
+from weighted_lag_features import add_weighted_lag_feature, add_weighted_lag_features
+from instrumentation import peak_rss_mb
+from news_store import NewsStore
+from trading_calendar import TradingCalendar
+from news_store import SENTIMENT_COLS
+from sector_aggregation import build_sector_datasets, stream_sector_datasets
+from data_io import read_frame
+from etf_transformations import (
+    compute_sector_daily_no_weekends,
+    compute_sector_and_embeddings_daily_no_weekends,
+    aggregate_to_next_trading_day_with_sectors,
+    aggregate_to_next_trading_day_sector_with_embeddings,
+)
+
+
+# 10_000_000 rows also works (--sizes ... 10000000) but synthetic_headlines needs several GB for it:
+# the (rows, 30) object array of words alone is 2.4 GB
+SIZES = (10_000, 100_000, 1_000_000)
+RESULTS_DIR = Path("../data/benchmarks")
+BASELINE_PATH = RESULTS_DIR / "baseline.json"
+
+START = news_headlines.START
+END = news_headlines.END
+
+# share of headlines flagged for each sector in the CNBC + Guardian data
+SECTOR_RATES = {"XLE": 0.03, "XLF": 0.07, "XLK": 0.04, "XLV": 0.07, "XLY": 0.09}
+
+# filler words, anything that matches a sector keyword is dropped below
+_WORDS = """
+the a of to in on for with as at by from after before over under amid ahead despite
+says said warns sees plans report reports year week month quarter day time people
+government minister talks deal market markets shares stock stocks investors trade
+growth jobs economy economic prices price profit profits sales record high low new
+first last big small more less up down rise rises fall falls cut cuts boost hits
+uk us china europe london brexit vote election court plan offer bid chief boss firm
+""".split()
+_MATCHER = KeywordMatcher(sector_keywords)
+_FILLER = np.array([w for w in _WORDS if not _MATCHER.count([w]).any()], dtype=object)
+
+
+def synthetic_headlines(n: int, n_emb: int = 16, sector_rates: dict = SECTOR_RATES,
+                        start=START, end=END, seed: int = 0) -> pd.DataFrame:
+    """
+    Synthetic headline table in the format of the final news dataset:
+    'Date', 'Headlines', 'Newspaper', one 0/1 flag per sector, FinBERT scores,
+    'is_trading_day' and emb_0..emb_<n_emb-1> (float32).
+
+    Headlines are 11 +- 3 filler words, each sector's keywords are inserted
+    with the probability in sector_rates, so the flags match what flag_sectors finds.
+    Dates are spread uniformly over [start, end] (weekends included).
+    """
+
+    rng = np.random.default_rng(seed)
+
+    lengths = np.clip(rng.normal(11, 3, n).round().astype(int), len(sector_rates), 30)
+    words = _FILLER[rng.integers(0, len(_FILLER), (n, lengths.max()))]
+
+    # some keywords also flag other sectors ("pipeline", "pharma pipeline", "insurance", ...)
+    sectors = list(sector_rates)
+    flags = np.zeros((n, len(sectors)), dtype=int)
+
+    for s, (sector, rate) in enumerate(sector_rates.items()):
+        hit = np.flatnonzero(rng.random(n) < rate)
+        keywords = np.array(sector_keywords[sector], dtype=object)
+        member = _MATCHER.count(list(keywords))[:, [_MATCHER.sectors.index(other) for other in sectors]] > 0
+
+        choice = rng.integers(0, len(keywords), len(hit))
+        words[hit, s] = keywords[choice]
+        flags[hit] |= member[choice]
+
+    days = pd.date_range(start, end)
+    dates = days[rng.integers(0, len(days), n)].sort_values()
+
+    df = pd.DataFrame({
+        "Date": dates,
+        "Headlines": [" ".join(row[:k]) for row, k in zip(words, lengths)],
+        "Newspaper": np.array(["cnbc", "guardian", "reuters"])[rng.integers(0, 3, n)],
+    })
+    for s, sector in enumerate(sectors):
+        df[sector] = flags[:, s]
+
+    scores = rng.dirichlet([1, 1, 1], n)
+    df["positive"], df["neutral"], df["negative"] = scores.T
+
+    calendar = TradingCalendar.load(start, end)
+    df["is_trading_day"] = calendar.is_trading_day(df["Date"]).astype(int)
+
+    emb = rng.standard_normal((n, n_emb), dtype=np.float32)
+    return pd.concat([df, pd.DataFrame(emb, columns=[f"emb_{i}" for i in range(n_emb)])], axis=1)
+
+
+def synthetic_raw_headlines(n: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Headlines in the raw CNBC layout ('Headlines', 'Time', 'Description'),
+    with times like ' 7:51  PM ET Fri, 17 July 2020'
+    """
+
+    df = synthetic_headlines(n, n_emb=0, seed=seed)
+    rng = np.random.default_rng(seed)
+
+    times = pd.DatetimeIndex(df["Date"]) + pd.to_timedelta(rng.integers(0, 24 * 60, n), unit="min")
+
+    return pd.DataFrame({
+        "Headlines": df["Headlines"],
+        "Time": times.strftime(" %I:%M  %p ET %a, %d %B %Y"),
+        "Description": df["Headlines"],
+    })
+
+
+def synthetic_prices(n: int, start=START, seed: int = 0) -> pd.DataFrame:
+    """
+    Random-walk ETF closes with 'Date' and 'Price',
+    business days if n fits before 2200, otherwise one row per minute
+    """
+
+    rng = np.random.default_rng(seed)
+    freq = "B" if n <= 40_000 else "min"
+
+    return pd.DataFrame({
+        "Date": pd.date_range(start, periods=n, freq=freq),
+        "Price": 50 * np.exp(np.cumsum(rng.normal(0, 0.01, n))),
+    })
+
+
+def write_raw_prices(prices: pd.DataFrame, csv_path: Path) -> Path:
+    """
+    Writes prices in the layout of the yfinance downloads in data/raw
+    (two extra header rows before the data)
+    """
+    ticker = Path(csv_path).stem.split("_")[0]
+
+    with open(csv_path, "w", newline="") as f:
+        f.write(f"Price,Close\nTicker,{ticker}\nDate,\n")
+        prices.to_csv(f, header=False, index=False)
+
+    return Path(csv_path)
+
+
+def write_etf_prices(tickers, csv_dir: Path, start=START, end=END, seed: int = 0) -> list:
+    """
+    Writes <TICKER>_preprocessed.csv files (Date, Price, Return, Sign) over the NYSE sessions
+    """
+
+    calendar = TradingCalendar.load(start, end)
+    sessions = calendar.sessions[(calendar.sessions >= np.datetime64(start)) & (calendar.sessions <= np.datetime64(end))]
+
+    paths = []
+    for i, ticker in enumerate(tickers):
+        prices = synthetic_prices(len(sessions), start, seed + i)
+        prices["Date"] = sessions
+        prices["Return"] = prices["Price"].pct_change()
+        prices["Sign"] = np.sign(prices["Return"])
+
+        paths.append(Path(csv_dir) / f"{ticker}_preprocessed.csv")
+        prices.to_csv(paths[-1], index=False)
+
+    return paths
+
+
+@contextmanager
+def _output_dirs(directory: Path):
+    """
+    Points the OUT_DIR of the preprocessing modules at a scratch directory
+    """
+    modules = [stock_prices, news_headlines, etf_transformations]
+    saved = [m.OUT_DIR for m in modules]
+
+    for m in modules:
+        m.OUT_DIR = Path(directory)
+    try:
+        yield
+    finally:
+        for m, out_dir in zip(modules, saved):
+            m.OUT_DIR = out_dir
+
+
+def _news_store(n, n_emb, seed):
+    df = synthetic_headlines(n, n_emb, seed=seed)
+    emb_cols = [c for c in df.columns if c.startswith("emb_")]
+    embeddings = df[emb_cols].to_numpy(dtype=np.float32)
+
+    meta = df.drop(columns=emb_cols)
+    for col in list(SECTOR_RATES) + ["is_trading_day"]:
+        meta[col] = meta[col].astype(np.int8)
+
+    return NewsStore(meta, embeddings, emb_cols)
+
+
+# every setup(n, workdir, n_emb, seed) prepares the inputs and returns the call to time
+def _setup_clean_headlines(n, workdir, n_emb, seed):
+    headlines = synthetic_headlines(n, n_emb=0, seed=seed)["Headlines"]
+    headlines = headlines.str.replace(" ", "  \u200b", n=1, regex=False)
+    return lambda: clean_headlines(headlines)
+
+
+def _setup_flag_sectors(n, workdir, n_emb, seed):
+    df = synthetic_headlines(n, n_emb=0, seed=seed)[["Date", "Headlines"]]
+    return lambda: flag_sectors(df.copy())
+
+
+def _setup_preprocess_news(n, workdir, n_emb, seed):
+    csv_path = Path(workdir) / "bench_headlines.csv"
+    synthetic_raw_headlines(n, seed).to_csv(csv_path, index=False)
+    return lambda: preprocess_news(csv_path)
+
+
+def _setup_preprocess_file(n, workdir, n_emb, seed):
+    csv_path = write_raw_prices(synthetic_prices(n, seed=seed), Path(workdir) / "XLE_prices.csv")
+    return lambda: preprocess_file(csv_path)
+
+
+def _setup_weighted_lag(n, workdir, n_emb, seed):
+    df = pd.DataFrame({"sent_index_XLE": np.random.default_rng(seed).normal(size=n)})
+    return lambda: add_weighted_lag_feature(df, "sent_index_XLE", [1, 2, 3], "sent_index_XLE_wlag3")
+
+
+def _setup_weighted_lags_grouped(n, workdir, n_emb, seed):
+    rng = np.random.default_rng(seed)
+    cols = [f"sent_index_{s}" for s in SECTOR_RATES]
+    df = pd.DataFrame(rng.normal(size=(n, len(cols))), columns=cols)
+    df["Ticker"] = rng.choice(list(SECTOR_RATES), n)
+    weights = {"wlag3": [1, 2, 3], "wlag5": [1, 2, 3, 4, 5], "wlag10": np.arange(1, 11)}
+    return lambda: add_weighted_lag_features(df, cols, weights, group_col="Ticker")
+
+
+def _builder_setup(builder, **kwargs):
+    def setup(n, workdir, n_emb, seed):
+        news_store = _news_store(n, n_emb, seed)
+        csv_path = write_etf_prices(["XLE"], workdir, seed=seed)[0]
+        if builder is compute_sector_daily_no_weekends:
+            kwargs["out_dir"] = workdir
+        if builder is compute_sector_and_embeddings_daily_no_weekends:
+            kwargs["emb_cols"] = news_store.emb_cols
+        return lambda: builder(csv_path, news_store=news_store, **kwargs)
+    return setup
+
+
+def _setup_build_sector_datasets(n, workdir, n_emb, seed):
+    news_store = _news_store(n, n_emb, seed)
+    csv_paths = write_etf_prices(list(SECTOR_RATES), workdir, seed=seed)
+    return lambda: build_sector_datasets(news_store, csv_paths)
+
+
+BENCHMARKS = {
+    "clean_headlines": _setup_clean_headlines,
+    "flag_sectors": _setup_flag_sectors,
+    "preprocess_news": _setup_preprocess_news,
+    "preprocess_file": _setup_preprocess_file,
+    "add_weighted_lag_feature": _setup_weighted_lag,
+    "add_weighted_lag_features_grouped": _setup_weighted_lags_grouped,
+    "compute_sector_daily_no_weekends": _builder_setup(compute_sector_daily_no_weekends),
+    "compute_sector_and_embeddings_daily_no_weekends": _builder_setup(compute_sector_and_embeddings_daily_no_weekends),
+    "aggregate_to_next_trading_day_with_sectors": _builder_setup(aggregate_to_next_trading_day_with_sectors),
+    "aggregate_to_next_trading_day_sector_with_embeddings": _builder_setup(aggregate_to_next_trading_day_sector_with_embeddings),
+    "build_sector_datasets": _setup_build_sector_datasets,
+}
+
+
+def check_sector_datasets(n: int = 20_000, n_emb: int = 4, min_headlines=(1, 3), seed: int = 0) -> int:
+    """
+    Checks that build_sector_datasets and stream_sector_datasets give the same v1-v4 tables
+    as the four per-ticker builders in etf_transformations, for every value in min_headlines,
+    on synthetic headlines (weekend news included, every 50th headline unscored).
+    Values are compared, not dtypes (the builders keep float32 embedding means).
+    Raises AssertionError (pd.testing.assert_frame_equal) at the first difference,
+    returns the number of tables compared.
+    """
+
+    builders = {
+        "v1": compute_sector_daily_no_weekends,
+        "v2": compute_sector_and_embeddings_daily_no_weekends,
+        "v3": aggregate_to_next_trading_day_with_sectors,
+        "v4": aggregate_to_next_trading_day_sector_with_embeddings,
+    }
+    compared = 0
+
+    with tempfile.TemporaryDirectory() as workdir, _output_dirs(workdir):
+        news = synthetic_headlines(n, n_emb, seed=seed)
+        news.loc[::50, list(SENTIMENT_COLS)] = np.nan
+        news_csv = Path(workdir) / "bench_news.csv"
+        news.to_csv(news_csv, index=False)
+
+        news_store = NewsStore.from_csv(news_csv)
+        csv_paths = write_etf_prices(list(SECTOR_RATES), workdir, seed=seed)
+
+        for k in min_headlines:
+            built = build_sector_datasets(news_store, csv_paths, min_headlines=k)
+            streamed = stream_sector_datasets(news_csv, csv_paths, min_headlines=k, chunksize=n // 7 + 1)
+
+            for csv_path in csv_paths:
+                ticker = csv_path.stem.split("_")[0]
+                for variant, builder in builders.items():
+                    kwargs = {"out_dir": workdir} if variant == "v1" else {}
+                    if variant == "v2":
+                        kwargs["emb_cols"] = news_store.emb_cols
+                    expected = read_frame(builder(csv_path, min_headlines=k, news_store=news_store,
+                                                  fmt="parquet", **kwargs))
+
+                    for result in (built, streamed):
+                        pd.testing.assert_frame_equal(result[ticker][variant], expected, check_dtype=False)
+                        compared += 1
+
+    return compared
+
+
+def measure(func, repeat: int = 3, memory: bool = True) -> dict:
+    """
+    Runs func repeat times and returns the best wall and CPU time in seconds,
+    plus (with memory=True) the peak of memory allocated during one extra traced run
+    (tracemalloc, covers Python and NumPy/pandas buffers) in MB
+    """
+
+    wall, cpu = [], []
+    for _ in range(repeat):
+        t0, c0 = time.perf_counter(), time.process_time()
+        func()
+        wall.append(time.perf_counter() - t0)
+        cpu.append(time.process_time() - c0)
+
+    result = {"wall_s": min(wall), "cpu_s": min(cpu)}
+
+    if memory:
+        tracemalloc.start()
+        try:
+            func()
+            result["peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+        finally:
+            tracemalloc.stop()
+
+    return result
+
+
+def run_benchmarks(sizes=SIZES, names=None, n_emb: int = 16, repeat: int = 3,
+                   memory: bool = True, seed: int = 0, verbose: bool = True) -> list:
+    """
+    Runs every benchmark (or the ones in names) at every size in sizes
+    and returns a list of result records (one dict per benchmark and size)
+    """
+
+    names = list(BENCHMARKS) if names is None else list(names)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        raise ValueError(f"unknown benchmarks {unknown}, available: {list(BENCHMARKS)}")
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir, _output_dirs(workdir):
+        for name in names:
+            for n in sizes:
+                func = BENCHMARKS[name](n, workdir, n_emb, seed)
+                record = {"benchmark": name, "rows": n, **measure(func, repeat, memory)}
+                record["rows_per_s"] = n / record["wall_s"] if record["wall_s"] > 0 else float("inf")
+                record["max_rss_mb"] = peak_rss_mb()
+                results.append(record)
+                del func
+
+                if verbose:
+                    print(f"{name:55s} {n:>10,d} rows  {record['wall_s']:9.3f} s  {record.get('peak_mb', float('nan')):9.1f} MB")
+
+    return results
+
+
+def save_results(results: list, path: Path, **info) -> Path:
+    """
+    Saves the records as JSON together with the library versions and machine
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    payload = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "machine": platform.platform(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        **info,
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(payload, f, indent=1)
+
+    return path
+
+
+def load_results(path: Path) -> list:
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+def scaling(results: list) -> pd.DataFrame:
+    """
+    Wall time per benchmark (rows) and size (columns), plus 'exponent':
+    the slope of log(time) over log(rows), 1.0 means linear scaling
+    """
+
+    df = pd.DataFrame(results)
+    curves = df.pivot(index="benchmark", columns="rows", values="wall_s")
+
+    def slope(group):
+        if len(group) < 2:
+            return np.nan
+        return np.polyfit(np.log(group["rows"]), np.log(group["wall_s"].clip(lower=1e-9)), 1)[0]
+
+    curves["exponent"] = df.groupby("benchmark")[["rows", "wall_s"]].apply(slope)
+    return curves
+
+
+def compare(results: list, baseline: list, threshold: float = 1.2) -> pd.DataFrame:
+    """
+    Joins a run with a baseline on (benchmark, rows) and returns the time and memory ratios
+    (current / baseline), 'regression' is True where the time ratio is above threshold
+    """
+
+    cols = ["benchmark", "rows", "wall_s"] + (["peak_mb"] if all("peak_mb" in r for r in results + baseline) else [])
+    current = pd.DataFrame(results)[cols]
+    base = pd.DataFrame(baseline)[cols]
+
+    out = current.merge(base, on=["benchmark", "rows"], suffixes=("", "_baseline"))
+    out["time_ratio"] = out["wall_s"] / out["wall_s_baseline"]
+    if "peak_mb" in cols:
+        out["memory_ratio"] = out["peak_mb"] / out["peak_mb_baseline"]
+    out["regression"] = out["time_ratio"] > threshold
+
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the src/ preprocessing functions")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES),
+                        help="numbers of headlines, 10000000 needs several GB of memory")
+    parser.add_argument("--only", nargs="+", default=None, help=f"subset of {list(BENCHMARKS)}")
+    parser.add_argument("--n-emb", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true")
+    parser.add_argument("--out", type=Path, default=RESULTS_DIR / f"run_{datetime.now():%Y%m%d_%H%M%S}.json")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=1.2)
+    parser.add_argument("--check", action="store_true",
+                        help="only check build_sector_datasets/stream_sector_datasets against the etf_transformations builders")
+    args = parser.parse_args()
+
+    if args.check:
+        print(f"{check_sector_datasets()} sector tables match the etf_transformations builders")
+        raise SystemExit(0)
+
+    results = run_benchmarks(args.sizes, args.only, args.n_emb, args.repeat, not args.no_memory)
+    save_results(results, args.baseline if args.save_baseline else args.out, n_emb=args.n_emb)
+
+    with pd.option_context("display.width", 200, "display.max_columns", 20):
+        print(scaling(results))
+
+        if not args.save_baseline and args.baseline.exists():
+            comparison = compare(results, load_results(args.baseline), args.threshold)
+            print(comparison)
+            if comparison["regression"].any():
+                raise SystemExit(1)
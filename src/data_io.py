@@ -0,0 +1,134 @@
+from pathlib import Path
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+from instrumentation import record_input, record_output
+
+
+FORMATS = {"parquet": ".parquet", "arrow": ".arrow", "csv": ".csv"}
+EMB_PREFIX = "emb_"
+
+# CSV layout: the same output folders as the per-ticker functions in etf_transformations
+VARIANT_SUBDIRS = {
+    "v1": "no_weekends_no_embedding",
+    "v2": "no_weekends_embedding",
+    "v3": "weekends_aggregated_no_embedding",
+    "v4": "weekends_aggregated_embedding",
+}
+
+
+def _to_arrow(df: pd.DataFrame) -> pa.Table:
+    """
+    Converts a DataFrame to an Arrow table with the embedding columns stored as float32
+    """
+    emb_cols = [c for c in df.columns if c.startswith(EMB_PREFIX) and df[c].dtype == np.float64]
+    if emb_cols:
+        df = df.astype({c: np.float32 for c in emb_cols})
+
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def write_frame(df: pd.DataFrame, path: Path, fmt: str = "parquet", compression: str = "zstd") -> Path:
+    """
+    Writes df as Parquet, Arrow IPC (Feather v2) or CSV.
+    The suffix of path is replaced by the one of the format.
+    Parquet and Arrow keep the column types and store embeddings as float32.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown format {fmt!r}, expected one of {list(FORMATS)}")
+
+    path = Path(path).with_suffix(FORMATS[fmt])
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    if fmt == "csv":
+        df.to_csv(path, index=False)
+    elif fmt == "parquet":
+        pq.write_table(_to_arrow(df), path, compression=compression)
+    else:
+        feather.write_feather(_to_arrow(df), path, compression=compression)
+
+    record_output(df)
+    return path
+
+
+def read_frame(path: Path, columns=None) -> pd.DataFrame:
+    """
+    Reads a file written by write_frame, only the given columns if columns is set
+    """
+    path = Path(path)
+
+    if path.suffix == ".csv":
+        return record_input(pd.read_csv(path, usecols=columns))
+    if path.suffix == ".parquet":
+        return record_input(pd.read_parquet(path, columns=columns))
+
+    return record_input(feather.read_table(path, columns=columns, memory_map=True).to_pandas())
+
+
+def partition_path(out_dir: Path, ticker: str, variant: str, fmt: str = "parquet") -> Path:
+    """
+    <out_dir>/ticker=<TICKER>/variant=<variant>/part-0.<fmt>
+    """
+    return Path(out_dir) / f"ticker={ticker}" / f"variant={variant}" / f"part-0{FORMATS[fmt]}"
+
+
+def dataset_path(out_dir, ticker, variant, fmt="parquet") -> Path:
+    """
+    Location of one ticker's variant: the ticker=/variant= partition for Parquet and Arrow,
+    the old <variant folder>/<TICKER>_<variant>.csv layout for CSV
+    """
+    if fmt == "csv":
+        return Path(out_dir) / VARIANT_SUBDIRS[variant] / f"{ticker}_{variant}.csv"
+    return partition_path(out_dir, ticker, variant, fmt)
+
+
+def _dataset_tickers(out_dir: Path, variant: str, fmt: str) -> list:
+    if fmt == "csv":
+        paths = (Path(out_dir) / VARIANT_SUBDIRS[variant]).glob(f"*_{variant}.csv")
+        return sorted(p.name[: -len(f"_{variant}.csv")] for p in paths)
+    return sorted(p.name.split("=", 1)[1] for p in Path(out_dir).glob("ticker=*"))
+
+
+def read_sector_dataset(out_dir: Path, ticker: str, variant: str, columns=None, fmt: str = "parquet") -> pd.DataFrame:
+    """
+    Loads one ticker's v1-v4 table, e.g. only ["Date", "Sign", "sent_index_XLE"]
+    """
+    return read_frame(dataset_path(out_dir, ticker, variant, fmt), columns)
+
+
+def _file_columns(path: Path) -> list:
+    if path.suffix == ".csv":
+        return list(pd.read_csv(path, nrows=0).columns)
+    if path.suffix == ".parquet":
+        return pq.read_schema(path).names
+
+    return feather.read_table(path, memory_map=True).schema.names
+
+
+def read_sector_datasets(out_dir: Path, variant: str, tickers=None, columns=None, fmt: str = "parquet") -> pd.DataFrame:
+    """
+    Loads one variant for several tickers (all if tickers is None) as one long table
+    with a 'ticker' column. Only the requested columns are read from disk;
+    ticker-specific names (e.g. sent_index_XLE) are read from the files that have them.
+    """
+    if tickers is None:
+        tickers = _dataset_tickers(out_dir, variant, fmt)
+
+    frames = []
+    for ticker in tickers:
+        path = dataset_path(out_dir, ticker, variant, fmt)
+        if not path.exists():
+            continue
+
+        cols = None
+        if columns is not None:
+            available = set(_file_columns(path))
+            cols = [c for c in columns if c in available]
+        frames.append(read_frame(path, cols).assign(ticker=ticker))
+
+    if not frames:
+        raise FileNotFoundError(f"no {variant} {fmt} datasets in {out_dir} (see dataset_path)")
+
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,241 @@
+from pathlib import Path
+import hashlib
+import os
+import pandas as pd
+import numpy as np
+from embedding_store import EmbeddingStore, EMB_DIM, EMB_DIR
+from news_store import NewsStore, EMB_PREFIX
+
+
+N_COMPONENTS = 200
+PCA_PREFIX = "pca_"
+PCA_DIR = EMB_DIR / "pca"
+PCA_PATH = EMB_DIR / "pca_model.npz"
+PROJECTION_FILES = ("vectors.npy", "index.npy")
+HASH_FILE = "pca_hash.txt"
+CHUNKSIZE = 200_000
+
+
+class StreamingPCA:
+    """
+    PCA fitted in one streaming pass over the embeddings.
+
+    Each block only updates the row count, the column sums and the (dim x dim) cross-product
+    (all float64, shifted by the mean of the first block for accuracy),
+    so the full matrix is never in memory and more rows can be added later with partial_fit.
+    finalize() takes the eigenvectors of the covariance: the same components as sklearn's PCA
+    (signs fixed the same way: the largest loading of each component is positive).
+    """
+
+    def __init__(self, n_components: int = N_COMPONENTS, dim: int = EMB_DIM):
+        self.n_components = n_components
+        self.dim = dim
+
+        self.n_seen = 0
+        self.shift = None
+        self.sums = np.zeros(dim)
+        self.cross = np.zeros((dim, dim))
+
+        self.mean = None
+        self.components = None
+        self.explained_variance = None
+        self.explained_variance_ratio = None
+
+    def partial_fit(self, block):
+        block = np.asarray(block, dtype=np.float64)
+        block = block[~np.isnan(block).any(axis=1)]
+        if len(block) == 0:
+            return self
+
+        if self.shift is None:
+            self.shift = block.mean(axis=0)
+        block = block - self.shift
+
+        self.n_seen += len(block)
+        self.sums += block.sum(axis=0)
+        self.cross += block.T @ block
+        return self
+
+    def finalize(self):
+        if self.n_seen < 2:
+            raise ValueError(f"need at least 2 rows to fit, got {self.n_seen}")
+
+        centered_mean = self.sums / self.n_seen
+        cov = (self.cross - self.n_seen * np.outer(centered_mean, centered_mean)) / (self.n_seen - 1)
+
+        eigenvalues, eigenvectors = np.linalg.eigh(cov)
+        order = np.argsort(eigenvalues)[::-1][: self.n_components]
+        components = eigenvectors[:, order].T
+
+        signs = np.sign(components[np.arange(len(components)), np.abs(components).argmax(axis=1)])
+        components *= signs[:, None]
+
+        self.mean = (self.shift + centered_mean).astype(np.float32)
+        self.components = components.astype(np.float32)
+        self.explained_variance = np.clip(eigenvalues[order], 0, None)
+        self.explained_variance_ratio = self.explained_variance / max(np.trace(cov), np.finfo(float).tiny)
+        return self
+
+    def fit(self, blocks):
+        """
+        blocks - iterable of (rows, dim) arrays, e.g. iter_blocks(store.vectors)
+        """
+        for block in blocks:
+            self.partial_fit(block)
+        return self.finalize()
+
+    def columns(self, n_components: int | None = None) -> list:
+        return [f"{PCA_PREFIX}{i}" for i in range(n_components or len(self.components))]
+
+    def transform(self, X, n_components: int | None = None, chunksize: int = CHUNKSIZE) -> np.ndarray:
+        """
+        Projects rows on the first n_components components (all by default),
+        returns float32, NaN rows stay NaN
+        """
+        components = self.components[: n_components or len(self.components)]
+        out = np.empty((len(X), len(components)), dtype=np.float32)
+
+        for start in range(0, len(X), chunksize):
+            block = np.asarray(X[start: start + chunksize], dtype=np.float32)
+            out[start: start + len(block)] = (block - self.mean) @ components.T
+
+        return out
+
+    def save(self, path: Path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp.npz")
+        np.savez(
+            tmp_path,
+            n_components=self.n_components, n_seen=self.n_seen, shift=self.shift, sums=self.sums, cross=self.cross,
+            mean=self.mean, components=self.components,
+            explained_variance=self.explained_variance, explained_variance_ratio=self.explained_variance_ratio,
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "StreamingPCA":
+        with np.load(path) as data:
+            pca = cls(int(data["n_components"]), data["sums"].shape[0])
+            pca.n_seen = int(data["n_seen"])
+            pca.shift = data["shift"]
+            pca.sums = data["sums"]
+            pca.cross = data["cross"]
+            pca.mean = data["mean"]
+            pca.components = data["components"]
+            pca.explained_variance = data["explained_variance"]
+            pca.explained_variance_ratio = data["explained_variance_ratio"]
+        return pca
+
+
+def iter_blocks(matrix, chunksize: int = CHUNKSIZE):
+    """
+    Yields float32 row blocks of a matrix or memmap, so only one block is in memory at a time
+    """
+    for start in range(0, len(matrix), chunksize):
+        yield np.asarray(matrix[start: start + chunksize], dtype=np.float32)
+
+
+def fit_store_pca(embedding_store: EmbeddingStore, n_components: int = N_COMPONENTS,
+                  chunksize: int = CHUNKSIZE, path: Path | None = PCA_PATH) -> StreamingPCA:
+    """
+    Fits the PCA on all vectors of the store (one per distinct headline)
+    and saves it to path
+    """
+    pca = StreamingPCA(n_components, embedding_store.dim).fit(iter_blocks(embedding_store.vectors, chunksize))
+    if path is not None:
+        pca.save(path)
+    return pca
+
+
+def _components_hash(pca: StreamingPCA) -> str:
+    """
+    Hash of the mean and components, identifies the PCA a projection was made with
+    """
+    digest = hashlib.sha256(str(pca.components.shape).encode())
+    digest.update(np.ascontiguousarray(pca.mean, dtype=np.float32).tobytes())
+    digest.update(np.ascontiguousarray(pca.components, dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
+
+def project_store(embedding_store: EmbeddingStore, pca: StreamingPCA, directory: Path = PCA_DIR,
+                  chunksize: int = CHUNKSIZE) -> EmbeddingStore:
+    """
+    Writes the float32 PCA components of the store's vectors to an EmbeddingStore
+    in directory (columns pca_0..), keyed by the same headline keys.
+
+    Only vectors that are not projected yet are processed, so after new headlines
+    were encoded this just projects the new rows, without refitting.
+    If the saved projection was made with a different PCA (the hash of its components is kept
+    in directory / HASH_FILE), its files are deleted and all vectors are projected again.
+    """
+
+    directory = Path(directory)
+    hash_path = directory / HASH_FILE
+    components_hash = _components_hash(pca)
+
+    saved_hash = hash_path.read_text().strip() if hash_path.exists() else None
+    if saved_hash != components_hash:
+        for name in PROJECTION_FILES + (HASH_FILE,):
+            (directory / name).unlink(missing_ok=True)
+        directory.mkdir(parents=True, exist_ok=True)
+        hash_path.write_text(components_hash)
+
+    reduced = EmbeddingStore(directory, dim=len(pca.components), prefix=PCA_PREFIX)
+
+    missing = np.flatnonzero(reduced.row_ids(embedding_store.keys) < 0)
+    for start in range(0, len(missing), chunksize):
+        rows = missing[start: start + chunksize]
+        reduced.append(embedding_store.keys[rows], pca.transform(embedding_store.vectors[rows]))
+
+    return reduced
+
+
+def reduce_news_store(news_store: NewsStore, pca: StreamingPCA | None = None, n_components: int = 50,
+                      reduced: EmbeddingStore | None = None, embedding_store: EmbeddingStore | None = None) -> NewsStore:
+    """
+    Same headlines with the first n_components PCA components instead of the embeddings,
+    so the sector aggregation averages pca_0..pca_<n-1> instead of emb_0..emb_383.
+
+    If the store points into an EmbeddingStore (emb_rows) and its projection is given,
+    the rows are mapped to the projected vectors without reading the embeddings,
+    otherwise the embeddings are projected with pca.
+    """
+
+    if news_store.emb_rows is not None and reduced is not None and embedding_store is not None:
+        rows = news_store.emb_rows
+        keys = embedding_store.keys[np.maximum(rows, 0)]
+        reduced_rows = np.where(rows >= 0, reduced.row_ids(keys), -1)
+
+        vectors = reduced.vectors[:, :n_components] if n_components < reduced.dim else reduced.vectors
+        return NewsStore(news_store.meta, vectors, reduced.emb_cols[:n_components], emb_rows=reduced_rows)
+
+    if pca is None:
+        raise ValueError("pass the pca, or the reduced and the full EmbeddingStore")
+
+    return NewsStore(news_store.meta, pca.transform(news_store.embedding_matrix(), n_components),
+                     pca.columns(n_components))
+
+
+def reduce_csv(csv_path: Path, out_path: Path, pca: StreamingPCA, n_components: int | None = None,
+               chunksize: int = 100_000) -> Path:
+    """
+    Copies a headline CSV with emb_* columns (e.g. final_data_with_embeddings_without_aggregations.csv)
+    chunk by chunk, replacing the embeddings with the float32 pca_* components
+    """
+
+    header = pd.read_csv(csv_path, nrows=0).columns
+    emb_cols = [c for c in header if c.startswith(EMB_PREFIX)]
+
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+
+    reader = pd.read_csv(csv_path, chunksize=chunksize, dtype={c: np.float32 for c in emb_cols})
+    for i, chunk in enumerate(reader):
+        components = pca.transform(chunk[emb_cols].to_numpy(dtype=np.float32), n_components)
+        chunk = chunk.drop(columns=emb_cols)
+        chunk[pca.columns(components.shape[1])] = components
+
+        chunk.to_csv(out_path, mode="w" if i == 0 else "a", header=i == 0, index=False)
+
+    return out_path
@@ -0,0 +1,151 @@
+from pathlib import Path
+import os
+import pandas as pd
+import numpy as np
+from news_headlines import clean_headlines, headline_keys, MISSING_KEY
+
+
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+EMB_DIM = 384
+EMB_DIR = Path("../data/preprocessed/embeddings")
+
+# fixed .npy header size, so appending rows only rewrites the shape in place
+_HEADER_SIZE = 128
+
+
+def _npy_header(n_rows, dim, dtype) -> bytes:
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d, %d), }" % (np.dtype(dtype).str, n_rows, dim)
+    header = header.encode("latin1")
+    length = _HEADER_SIZE - 10
+    header = header + b" " * (length - len(header) - 1) + b"\n"
+
+    return b"\x93NUMPY\x01\x00" + length.to_bytes(2, "little") + header
+
+
+class EmbeddingStore:
+    """
+    Append-only store of sentence embeddings, one vector per distinct headline.
+
+    Files in the directory:
+    - vectors.npy - (n_vectors, dim) float32 or float16 matrix, read as a memmap,
+    - index.npy   - uint64 headline_keys() of the vectors, row i of index = row i of vectors.
+
+    The row id of a headline is its position in vectors.npy,
+    so tables only need to carry an 'emb_row' column instead of emb_0..emb_383.
+    prefix names the columns in emb_cols (e.g. "pca_" for a store of reduced vectors).
+    """
+
+    def __init__(self, directory: Path = EMB_DIR, dim: int = EMB_DIM, dtype=np.float32, prefix: str = "emb_"):
+        self.directory = Path(directory)
+        self.prefix = prefix
+        self.vectors_path = self.directory / "vectors.npy"
+        self.index_path = self.directory / "index.npy"
+
+        if self.vectors_path.exists():
+            self.vectors = np.load(self.vectors_path, mmap_mode="r")
+            self.keys = np.load(self.index_path)[: len(self.vectors)]
+            self.dim = self.vectors.shape[1]
+            self.dtype = self.vectors.dtype
+        else:
+            self.dim = dim
+            self.dtype = np.dtype(dtype)
+            self.vectors = np.zeros((0, dim), dtype=self.dtype)
+            self.keys = np.zeros(0, dtype=np.uint64)
+
+        self._sort_keys()
+
+    def _sort_keys(self):
+        self._order = np.argsort(self.keys, kind="stable")
+        self._sorted_keys = self.keys[self._order]
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def emb_cols(self) -> list:
+        return [f"{self.prefix}{i}" for i in range(self.dim)]
+
+    def row_ids(self, keys) -> np.ndarray:
+        """
+        Row ids (int64) of the given headline keys, -1 for keys that are not stored
+        """
+        keys = np.asarray(keys, dtype=np.uint64)
+        rows = np.full(len(keys), -1, dtype=np.int64)
+
+        if len(self.keys):
+            pos = np.minimum(np.searchsorted(self._sorted_keys, keys), len(self.keys) - 1)
+            found = self._sorted_keys[pos] == keys
+            rows[found] = self._order[pos[found]]
+
+        return rows
+
+    def append(self, keys, vectors) -> np.ndarray:
+        """
+        Appends vectors for new keys (keys already stored are skipped)
+        and returns the row ids of all given keys
+        """
+        keys = np.asarray(keys, dtype=np.uint64)
+        vectors = np.asarray(vectors).reshape(len(keys), self.dim)
+
+        new_keys, first = np.unique(keys, return_index=True)
+        new = self.row_ids(new_keys) < 0
+        new_keys, first = new_keys[new], first[new]
+
+        if len(new_keys):
+            self.directory.mkdir(parents=True, exist_ok=True)
+            n_old = len(self.keys)
+
+            mode = "r+b" if self.vectors_path.exists() else "w+b"
+            with open(self.vectors_path, mode) as f:
+                f.seek(_HEADER_SIZE + n_old * self.dim * self.dtype.itemsize)
+                f.write(np.ascontiguousarray(vectors[first], dtype=self.dtype).tobytes())
+                f.truncate()
+
+                self.keys = np.concatenate([self.keys, new_keys])
+                tmp_path = self.index_path.with_suffix(".tmp.npy")
+                np.save(tmp_path, self.keys)
+                os.replace(tmp_path, self.index_path)
+
+                f.seek(0)
+                f.write(_npy_header(len(self.keys), self.dim, self.dtype))
+
+            self.vectors = np.load(self.vectors_path, mmap_mode="r")
+            self._sort_keys()
+
+        return self.row_ids(keys)
+
+    def encode(self, headlines: pd.Series, model=None, batch_size: int = 64) -> np.ndarray:
+        """
+        Returns the row ids of the headlines,
+        encoding (with all-MiniLM-L6-v2 by default) only the headlines that are not stored yet,
+        missing headlines get -1
+        """
+        keys = headline_keys(headlines)
+        rows = self.row_ids(keys)
+
+        missing = np.flatnonzero((rows < 0) & (keys != MISSING_KEY))
+        if len(missing):
+            missing_keys, first = np.unique(keys[missing], return_index=True)
+            texts = clean_headlines(headlines.iloc[missing[first]]).tolist()
+
+            if model is None:
+                from sentence_transformers import SentenceTransformer
+                model = SentenceTransformer(MODEL_NAME)
+
+            vectors = model.encode(texts, batch_size=batch_size, show_progress_bar=False, convert_to_numpy=True)
+            self.append(missing_keys, vectors)
+            rows = self.row_ids(keys)
+
+        return rows
+
+    def take(self, rows) -> np.ndarray:
+        """
+        float32 vectors of the given row ids (NaN rows for -1)
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        out = np.full((len(rows), self.dim), np.nan, dtype=np.float32)
+
+        valid = rows >= 0
+        out[valid] = self.vectors[rows[valid]]
+
+        return out
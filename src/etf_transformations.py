@@ -1,7 +1,10 @@
 from pathlib import Path
 import pandas as pd
 import numpy as np
-import pandas_market_calendars as mcal
+from news_store import NewsStore
+from trading_calendar import TradingCalendar
+from data_io import write_frame, dataset_path
+from instrumentation import stage, record_input
 
 
 RAW_DIR = Path("../data/preprocessed/etfs")
@@ -11,29 +14,51 @@ OUT_DIR = Path("../data/preprocessed/final_etf_data")
 OUT_DIR.mkdir(parents=True, exist_ok=True)
 
 
+@stage
 def sign_next_day(df):
     df["Sign_next_day"] = df["Sign"].shift(-1)
     
     return df
 
 
+@stage
 def drop_sign_and_return(df):
     return df.drop(columns=["Sign", "Return"])
 
 
+@stage
 def is_trading_day_column(df):
     df['Date'] = pd.to_datetime(df['Date']).dt.normalize()
-    nyse = mcal.get_calendar('NYSE')
+    calendar = TradingCalendar.load(df['Date'].min(), df['Date'].max())
 
-    schedule = nyse.schedule(start_date = df['Date'].min(), end_date = df['Date'].max())
-    trading_days = schedule.index.normalize()
-
-    df['is_trading_day'] = df['Date'].isin(trading_days).astype(int)
+    df['is_trading_day'] = calendar.is_trading_day(df['Date']).astype(int)
     return df
 
 
 
-def compute_sector_daily_no_weekends(csv_path, out_dir, min_headlines=1):
+def _load_news_store(news_store):
+    """
+    Returns the given store, or reads NEWS_DIR into a new one
+    if no store was passed in
+    """
+    if news_store is None:
+        news_store = NewsStore.from_csv(NEWS_DIR)
+    return news_store
+
+
+def _add_trading_date(news_df):
+    """
+    Adds 'TradingDate': the date itself on trading days, otherwise the next NYSE session,
+    so weekend and holiday news is counted on the next trading day
+    """
+    calendar = TradingCalendar.load(news_df["Date"].min(), news_df["Date"].max())
+    news_df["TradingDate"] = calendar.next_trading_date(news_df["Date"])
+
+    return news_df.dropna(subset=["TradingDate"])
+
+
+@stage
+def compute_sector_daily_no_weekends(csv_path, out_dir, min_headlines=1, news_store: NewsStore | None = None, fmt: str = "csv"):
     """
     Calculates daily average sentiment scores for a selected sector.
 
@@ -43,19 +68,22 @@ def compute_sector_daily_no_weekends(csv_path, out_dir, min_headlines=1):
     - counts how many sector-related headlines were found,
     - computes a simple sentiment index (positive - negative),
     - returns one row per day with all aggregated values
+
+    Pass a NewsStore to reuse an already loaded copy of the headlines,
+    and fmt="parquet" or "arrow" to write a typed file instead of CSV
+    (in the ticker=/variant= partition, see dataset_path).
     """
 
     ticker = csv_path.stem.split("_")[0]
 
-    news_df = pd.read_csv(NEWS_DIR)
-    df = pd.read_csv(csv_path)
+    news_store = _load_news_store(news_store)
+    df = record_input(pd.read_csv(csv_path))
 
     df = df.copy()
     df["Date"] = pd.to_datetime(df["Date"]).dt.normalize()
-    news_df["Date"] = pd.to_datetime(news_df["Date"]).dt.normalize()
 
     # only headlines tagged for this sector
-    sector_df = news_df.loc[news_df[ticker] == 1, ["Date", "positive", "neutral", "negative"]]
+    sector_df = news_store.frame(["Date", "positive", "neutral", "negative"], mask=news_store.sector_mask(ticker))
 
     daily_sentiment_score = (
         sector_df.groupby("Date", as_index=False)
@@ -85,17 +113,14 @@ def compute_sector_daily_no_weekends(csv_path, out_dir, min_headlines=1):
 
     dfs_combined = df.merge(daily_sentiment_score, on="Date", how='left')
 
-    subdir = Path(out_dir) / "no_weekends_no_embedding"
-    subdir.mkdir(parents=True, exist_ok=True)
-    out_path = subdir / f"{ticker}_v1.csv"
-
-    dfs_combined.to_csv(out_path, index=False)
+    out_path = write_frame(dfs_combined, dataset_path(out_dir, ticker, "v1", fmt), fmt)
 
     return out_path
 
 
 
-def compute_sector_and_embeddings_daily_no_weekends(csv_path, emb_cols, min_headlines=1, prefix_emb: bool=True):
+@stage
+def compute_sector_and_embeddings_daily_no_weekends(csv_path, emb_cols, min_headlines=1, prefix_emb: bool=True, news_store: NewsStore | None = None, fmt: str = "csv"):
     """
     Calculates daily average sentiment scores for a selected sector.
 
@@ -106,20 +131,24 @@ def compute_sector_and_embeddings_daily_no_weekends(csv_path, emb_cols, min_head
     - computes a simple sentiment index (positive - negative),
     - aggregates the embeddings,
     - returns one row per day with all aggregated values
+
+    Pass a NewsStore to reuse an already loaded copy of the headlines,
+    and fmt="parquet" or "arrow" to write a typed file instead of CSV
+    (in the ticker=/variant= partition, see dataset_path).
     """
     ticker = csv_path.stem.split("_")[0]
 
-    news_df = pd.read_csv(NEWS_DIR)
-    df = pd.read_csv(csv_path)
+    news_store = _load_news_store(news_store)
+    df = record_input(pd.read_csv(csv_path))
     df = df.copy()
     df["Date"] = pd.to_datetime(df["Date"]).dt.normalize()
-    news_df["Date"] = pd.to_datetime(news_df["Date"]).dt.normalize()
-
-
-    columns_to_compute = ["Date", "positive", "neutral", "negative"] + list(emb_cols)
 
     # only headlines tagged for this sector
-    sector_df = news_df.loc[news_df[ticker] == 1, columns_to_compute].copy()
+    sector_df = news_store.frame(
+        ["Date", "positive", "neutral", "negative"],
+        emb_cols=list(emb_cols),
+        mask=news_store.sector_mask(ticker),
+    )
 
     daily_sentiment_score = (
         sector_df.groupby("Date", as_index=False)
@@ -164,35 +193,26 @@ def compute_sector_and_embeddings_daily_no_weekends(csv_path, emb_cols, min_head
 
     combined_dfs = df.merge(out, on="Date", how="left")
 
-    subdir = OUT_DIR / "no_weekends_embedding"
-    subdir.mkdir(parents=True, exist_ok=True)
-    out_path = subdir / f"{ticker}_v2.csv"
-    combined_dfs.to_csv(out_path, index=False)
+    out_path = write_frame(combined_dfs, dataset_path(OUT_DIR, ticker, "v2", fmt), fmt)
 
     return out_path
 
 
 
-def aggregate_to_next_trading_day_with_sectors(csv_path, min_headlines=1):
+@stage
+def aggregate_to_next_trading_day_with_sectors(csv_path, min_headlines=1, news_store: NewsStore | None = None, fmt: str = "csv"):
     ticker = csv_path.stem.split("_")[0]
 
-    news_df = pd.read_csv(NEWS_DIR)
-    df = pd.read_csv(csv_path)
+    news_store = _load_news_store(news_store)
+    df = record_input(pd.read_csv(csv_path))
     df = df.copy()
     df["Date"] = pd.to_datetime(df["Date"]).dt.normalize()
     df = df.sort_values("Date")
 
-    news_df["Date"] = pd.to_datetime(news_df["Date"]).dt.normalize()
-    news_df = news_df.sort_values("Date")
-
+    news_df = news_store.frame(["Date", "positive", "neutral", "negative"], mask=news_store.sector_mask(ticker))
+    news_df = _add_trading_date(news_df)
 
-    date_flags = (news_df[["Date", "is_trading_day"]].drop_duplicates("Date").sort_values("Date").reset_index(drop=True))
-    date_flags["TradingDate"] = date_flags["Date"].where(date_flags["is_trading_day"]==1)
-    date_flags["TradingDate"] = date_flags["TradingDate"].bfill()
-
-    news_df = news_df.merge(date_flags[["Date", "TradingDate"]], on="Date", how="left").dropna(subset=["TradingDate"])
-
-    sector = news_df.loc[news_df[ticker] ==1, ["TradingDate", "positive", "neutral", "negative"]]
+    sector = news_df[["TradingDate", "positive", "neutral", "negative"]]
 
     out = (
         sector.groupby("TradingDate", as_index=False)
@@ -222,38 +242,32 @@ def aggregate_to_next_trading_day_with_sectors(csv_path, min_headlines=1):
 
     combine_dfs = df.merge(out, on="Date", how='left')
 
-    subdir = Path(OUT_DIR) / "weekends_aggregated_no_embedding"
-    subdir.mkdir(parents=True, exist_ok=True)
-    out_path = subdir / f"{ticker}_v3.csv"
-    combine_dfs.to_csv(out_path, index=False)
+    out_path = write_frame(combine_dfs, dataset_path(OUT_DIR, ticker, "v3", fmt), fmt)
 
     return out_path
 
 
-def aggregate_to_next_trading_day_sector_with_embeddings(csv_path, min_headlines=1):
+@stage
+def aggregate_to_next_trading_day_sector_with_embeddings(csv_path, min_headlines=1, news_store: NewsStore | None = None, fmt: str = "csv"):
     ticker = csv_path.stem.split("_")[0]
     
-    df = pd.read_csv(csv_path)
+    df = record_input(pd.read_csv(csv_path))
     df = df.copy()
     df["Date"] = pd.to_datetime(df["Date"]).dt.normalize()
     df = df.sort_values("Date")
 
-    news_df = pd.read_csv(NEWS_DIR)
-    news_df = news_df.copy()
-    news_df["Date"] = pd.to_datetime(news_df["Date"]).dt.normalize()
-    news_df = news_df.sort_values("Date")
-
-    emb_cols = [c for c in news_df.columns if c.startswith("emb_")]
+    news_store = _load_news_store(news_store)
+    emb_cols = news_store.emb_cols
 
-    date_flags = (news_df[["Date", "is_trading_day"]].drop_duplicates("Date").sort_values("Date").reset_index(drop=True))
-    date_flags["TradingDate"] = date_flags["Date"].where(date_flags["is_trading_day"] == 1)
-    date_flags["TradingDate"] = date_flags["TradingDate"].bfill()
-
-    news_df = news_df.merge(date_flags[["Date", "TradingDate"]], on="Date", how="left")
-    news_df = news_df.dropna(subset=["TradingDate"])
+    news_df = news_store.frame(
+        ["Date", "positive", "neutral", "negative"],
+        emb_cols=emb_cols,
+        mask=news_store.sector_mask(ticker),
+    )
+    news_df = _add_trading_date(news_df)
 
     cols = ["TradingDate", "positive", "neutral", "negative"] + list(emb_cols)
-    sector = news_df.loc[news_df[ticker] == 1, cols]
+    sector = news_df[cols]
 
     g = sector.groupby("TradingDate", as_index=False)
 
@@ -289,9 +303,6 @@ def aggregate_to_next_trading_day_sector_with_embeddings(csv_path, min_headlines
 
     combined_dfs = df.merge(out, on="Date", how="left")
 
-    subdir = Path(OUT_DIR) / "weekends_aggregated_embedding"
-    subdir.mkdir(parents=True, exist_ok=True)
-    out_path = subdir / f"{ticker}_v4.csv"
-    combined_dfs.to_csv(out_path, index=False)
+    out_path = write_frame(combined_dfs, dataset_path(OUT_DIR, ticker, "v4", fmt), fmt)
 
     return out_path
@@ -0,0 +1,194 @@
+from pathlib import Path
+import os
+import pandas as pd
+import numpy as np
+from news_headlines import clean_headlines, headline_keys, MISSING_KEY
+
+
+MODEL_NAME = "ProsusAI/finbert"
+LABELS = ["positive", "neutral", "negative"]
+MAX_LENGTH = 64
+CACHE_PATH = Path("../data/preprocessed/cache/finbert_scores.npz")
+
+
+class ScoreCache:
+    """
+    On-disk cache of FinBERT probabilities keyed by headline_keys(),
+    kept as a sorted uint64 key array and a (n, 3) float32 score matrix
+    in the order of LABELS
+    """
+
+    def __init__(self, path: Path = CACHE_PATH):
+        self.path = Path(path)
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.scores = np.zeros((0, len(LABELS)), dtype=np.float32)
+
+        if self.path.exists():
+            with np.load(self.path) as data:
+                self.keys = data["keys"]
+                self.scores = data["scores"]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, keys):
+        """
+        Returns (found mask, scores), rows that are not cached are NaN
+        """
+        keys = np.asarray(keys, dtype=np.uint64)
+        scores = np.full((len(keys), len(LABELS)), np.nan, dtype=np.float32)
+
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=bool), scores
+
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = self.keys[pos] == keys
+        scores[found] = self.scores[pos[found]]
+
+        return found, scores
+
+    def add(self, keys, scores):
+        """
+        Adds new scores, keys that are already cached keep their old value
+        """
+        keys = np.concatenate([self.keys, np.asarray(keys, dtype=np.uint64)])
+        scores = np.concatenate([self.scores, np.asarray(scores, dtype=np.float32)])
+
+        self.keys, first = np.unique(keys, return_index=True)
+        self.scores = scores[first]
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp.npz")
+        np.savez(tmp_path, keys=self.keys, scores=self.scores)
+        os.replace(tmp_path, self.path)
+
+
+class FinbertScorer:
+    """
+    CPU FinBERT inference with length bucketing.
+
+    Headlines are tokenized once without padding, sorted by token length
+    and grouped into batches of at most max_tokens padded tokens,
+    so short headlines are not padded to the longest one in the corpus.
+    Probabilities are written straight into a preallocated array.
+    """
+
+    def __init__(self, model_name=MODEL_NAME, max_length=MAX_LENGTH, max_tokens=8192,
+                 max_batch_size=256, num_threads=None, local_files_only=False):
+        import torch
+        from transformers import AutoTokenizer, AutoModelForSequenceClassification
+
+        # only when asked for: the process-wide setting belongs to the caller (and to pool workers)
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+        self.torch = torch
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, local_files_only=local_files_only)
+        self.model = AutoModelForSequenceClassification.from_pretrained(model_name, local_files_only=local_files_only)
+        self.model.eval()
+
+        self.max_length = max_length
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+
+        # model output index of every label in LABELS
+        id2label = {i: label.lower() for i, label in self.model.config.id2label.items()}
+        self.label_order = [next(i for i, label in id2label.items() if label == name) for name in LABELS]
+
+    def batches(self, lengths):
+        """
+        Splits the row indices into batches of similar token length
+        """
+        order = np.argsort(lengths, kind="stable")
+        start = 0
+
+        while start < len(order):
+            end = start + 1
+            while end < len(order) and end - start < self.max_batch_size \
+                    and (end - start + 1) * lengths[order[end]] <= self.max_tokens:
+                end += 1
+            yield order[start:end]
+            start = end
+
+    def predict(self, headlines) -> np.ndarray:
+        """
+        (n, 3) float32 array of softmax probabilities in the order of LABELS
+        """
+        headlines = list(headlines)
+        probs = np.empty((len(headlines), len(LABELS)), dtype=np.float32)
+        if not headlines:
+            return probs
+
+        encodings = self.tokenizer(headlines, truncation=True, max_length=self.max_length, padding=False)
+        input_ids = encodings["input_ids"]
+        lengths = np.array([len(ids) for ids in input_ids])
+
+        with self.torch.inference_mode():
+            for idx in self.batches(lengths):
+                batch = self.tokenizer.pad(
+                    {key: [encodings[key][i] for i in idx] for key in encodings.keys()},
+                    return_tensors="pt",
+                )
+                logits = self.model(**batch).logits
+                probs[idx] = self.torch.softmax(logits, dim=-1)[:, self.label_order].numpy()
+
+        return probs
+
+
+def score_headlines(headlines: pd.Series, scorer: FinbertScorer | None = None,
+                    cache: ScoreCache | None = None) -> pd.DataFrame:
+    """
+    Scores the headlines with FinBERT and returns a DataFrame (same index) with
+    'positive', 'neutral', 'negative', 'finbert_label' and 'finbert_confidence'.
+
+    Headlines are cleaned and hashed, each distinct headline is scored once,
+    and with a cache only headlines that were never scored before go through the model.
+    The cache is updated and saved when new headlines were scored.
+    Missing headlines get NaN scores and no label.
+
+    >>> import tempfile
+    >>> class Stub:
+    ...     def predict(self, texts):
+    ...         return np.tile(np.float32([0.7, 0.2, 0.1]), (len(texts), 1))
+    >>> path = Path(tempfile.mkdtemp()) / "scores.npz"
+    >>> out = score_headlines(pd.Series(["Oil prices rise", "Oil prices  rise", None]), Stub(), ScoreCache(path))
+    >>> out["finbert_label"].tolist()[:2], out["finbert_label"].isna().tolist()
+    (['positive', 'positive'], [False, False, True])
+    >>> cache = ScoreCache(path)
+    >>> len(cache), cache.lookup(headline_keys(pd.Series(["Oil prices rise"])))[0].tolist()
+    (1, [True])
+    """
+
+    keys = headline_keys(headlines)
+    unique_keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    missing_key = unique_keys == MISSING_KEY
+
+    if cache is not None:
+        found, unique_scores = cache.lookup(unique_keys)
+    else:
+        found = np.zeros(len(unique_keys), dtype=bool)
+        unique_scores = np.empty((len(unique_keys), len(LABELS)), dtype=np.float32)
+
+    unique_scores[missing_key] = np.nan
+    missing = np.flatnonzero(~found & ~missing_key)
+    if len(missing):
+        if scorer is None:
+            scorer = FinbertScorer()
+
+        texts = clean_headlines(headlines.iloc[first[missing]]).tolist()
+        unique_scores[missing] = scorer.predict(texts)
+
+        if cache is not None:
+            cache.add(unique_keys[missing], unique_scores[missing])
+            cache.save()
+
+    scores = unique_scores[inverse]
+    scored = ~np.isnan(scores).any(axis=1)
+    best = np.where(scored, np.nan_to_num(scores, nan=-1).argmax(axis=1), 0)
+
+    out = pd.DataFrame(scores.astype(np.float64), columns=LABELS, index=headlines.index)
+    out["finbert_label"] = np.where(scored, np.array(LABELS, dtype=object)[best], None)
+    out["finbert_confidence"] = scores[np.arange(len(scores)), best].astype(np.float64)
+
+    return out
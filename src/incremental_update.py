@@ -0,0 +1,284 @@
+from pathlib import Path
+import io
+import os
+import pandas as pd
+import numpy as np
+from news_headlines import clean_headlines, flag_sectors, headline_keys
+from news_store import NewsStore, SENTIMENT_COLS
+from finbert_scoring import score_headlines
+from trading_calendar import TradingCalendar
+from etf_transformations import OUT_DIR
+from data_io import FORMATS, read_frame, write_frame
+from sector_aggregation import (
+    VARIANTS, dataset_path, compute_partials, merge_partials, partials_from_store,
+    remap_dates, select_dates, variant_frame, save_partials, load_partials,
+)
+
+
+STATE_DIR = Path("../data/preprocessed/cache/incremental")
+PARTIALS_FILE = "sector_partials.npz"
+KEYS_FILE = "ingested_keys.npy"
+
+
+def _ingest_keys(news_df) -> np.ndarray:
+    """
+    Hash of (date, cleaned headline), used to skip rows that were already ingested
+    """
+    dates = pd.to_datetime(news_df["Date"]).dt.strftime("%Y-%m-%d")
+    return headline_keys(dates + " " + news_df["Headlines"].astype(str))
+
+
+def initialize_state(news_store: NewsStore, state_dir: Path = STATE_DIR):
+    """
+    Saves the per-(sector, Date) partials and the keys of all headlines in the store,
+    the starting point for update_sector_datasets.
+    Run once after a full build.
+    """
+    state_dir = Path(state_dir)
+    save_partials(partials_from_store(news_store), state_dir / PARTIALS_FILE)
+    np.save(state_dir / KEYS_FILE, np.unique(_ingest_keys(news_store.meta)))
+
+
+def prepare_headlines(raw: pd.DataFrame, scorer=None, score_cache=None, embedding_store=None,
+                      embed_model=None) -> pd.DataFrame:
+    """
+    Runs new headlines (columns 'Date' and 'Headlines') through the same steps as the full build:
+    clean_headlines, flag_sectors, FinBERT scores (through the score cache)
+    and, with an embedding store, the 'emb_row' of each headline (only unseen ones are encoded)
+    """
+
+    news_df = raw.copy()
+    news_df["Date"] = pd.to_datetime(news_df["Date"]).dt.normalize()
+    news_df["Headlines"] = clean_headlines(news_df["Headlines"])
+    news_df = flag_sectors(news_df)
+
+    news_df = news_df.join(score_headlines(news_df["Headlines"], scorer, score_cache))
+
+    if embedding_store is not None:
+        news_df["emb_row"] = embedding_store.encode(news_df["Headlines"], model=embed_model)
+
+    calendar = TradingCalendar.load(news_df["Date"].min(), news_df["Date"].max())
+    news_df["is_trading_day"] = calendar.is_trading_day(news_df["Date"]).astype(int)
+
+    return news_df
+
+
+def ingest_headlines(news_df: pd.DataFrame, state_dir: Path = STATE_DIR, embedding_store=None):
+    """
+    Adds the headlines that were not ingested before to the saved partials.
+    news_df needs 'Date', 'Headlines', the sector flags and the FinBERT scores,
+    plus 'emb_row' (or an embedding_store to look the headlines up) if the state has embeddings.
+
+    Returns (all partials, partials of the new headlines only).
+    """
+
+    state_dir = Path(state_dir)
+    total = load_partials(state_dir / PARTIALS_FILE)
+    seen = np.load(state_dir / KEYS_FILE)
+
+    keys = _ingest_keys(news_df)
+    fresh = np.zeros(len(keys), dtype=bool)
+    fresh[np.unique(keys, return_index=True)[1]] = True
+    fresh &= ~np.isin(keys, seen)
+    news_df = news_df.loc[fresh]
+
+    blocks = [news_df[SENTIMENT_COLS].to_numpy(dtype=np.float64)]
+    if len(total.features) > len(SENTIMENT_COLS):
+        if embedding_store is None:
+            raise ValueError("the saved partials include embeddings, pass the embedding_store")
+        if "emb_row" in news_df.columns:
+            rows = news_df["emb_row"].to_numpy(dtype=np.int64)
+        else:
+            rows = embedding_store.row_ids(headline_keys(news_df["Headlines"]))
+        blocks.append((embedding_store.vectors, rows))
+
+    new = compute_partials(
+        pd.to_datetime(news_df["Date"]).dt.normalize().to_numpy(),
+        news_df[total.sectors].to_numpy(),
+        blocks,
+        total.sectors,
+        total.features,
+    )
+
+    if len(new.dates):
+        total = merge_partials([total, new])
+        save_partials(total, state_dir / PARTIALS_FILE)
+        np.save(state_dir / KEYS_FILE, np.union1d(seen, keys[fresh]))
+
+    return total, new
+
+
+def _read_tail(csv_path, start):
+    """
+    Reads the rows of a date-sorted CSV from the last row before start to the end
+    without parsing the rest of the file.
+    Returns (byte offset where those rows begin, DataFrame of the rows).
+    """
+    start = np.datetime64(pd.Timestamp(start), "ns")
+
+    with open(csv_path, "rb") as f:
+        header = f.readline()
+        body_start = f.tell()
+        end = f.seek(0, os.SEEK_END)
+        size = 1 << 16
+
+        while True:
+            pos = max(body_start, end - size)
+            f.seek(pos)
+            lines = f.read(end - pos).splitlines(keepends=True)
+            if pos > body_start:
+                lines = lines[1:]  # may start in the middle of a row
+
+            rows = pd.read_csv(io.BytesIO(header + b"".join(lines)))
+            dates = pd.to_datetime(rows["Date"]).to_numpy(dtype="datetime64[ns]")
+            before = np.flatnonzero(dates < start)
+
+            if len(before) or pos == body_start:
+                break
+            size *= 4
+
+    first = before[-1] if len(before) else 0
+    offset = end - sum(len(line) for line in lines[first:])
+    rows = rows.iloc[first:].reset_index(drop=True)
+    rows["Date"] = pd.to_datetime(rows["Date"])
+
+    return offset, rows
+
+
+def _write_tail(csv_path, offset, rows):
+    with open(csv_path, "r+b") as f:
+        f.truncate(offset)
+        f.seek(offset)
+        rows.to_csv(f, header=False, index=False)
+
+
+def _extend_prices(prices: pd.DataFrame, new_prices: pd.DataFrame) -> pd.DataFrame:
+    """
+    Appends the new (Date, Price) rows after the last date in prices,
+    with Return and Sign computed from the previous price,
+    and refreshes Sign_next_day if the table has it
+    """
+    new_prices = new_prices[["Date", "Price"]].copy()
+    new_prices["Date"] = pd.to_datetime(new_prices["Date"]).dt.normalize()
+
+    if len(prices):
+        new_prices = new_prices[new_prices["Date"] > prices["Date"].max()]
+    new_prices = new_prices.sort_values("Date").drop_duplicates("Date", keep="last")
+
+    out = pd.concat([prices, new_prices], ignore_index=True)
+
+    is_new = np.r_[np.zeros(len(prices), dtype=bool), np.ones(len(new_prices), dtype=bool)]
+    returns = out["Price"].pct_change()
+    out.loc[is_new, "Return"] = returns[is_new]
+    out.loc[is_new, "Sign"] = np.sign(returns[is_new])
+
+    if "Sign_next_day" in out.columns:
+        out["Sign_next_day"] = out["Sign"].shift(-1)
+
+    return out
+
+
+def append_prices(csv_path: Path, new_prices: pd.DataFrame) -> pd.DataFrame:
+    """
+    Appends new prices to a <TICKER>_preprocessed.csv file,
+    only the last row of the file is read
+    """
+    new_prices = new_prices.assign(Date=pd.to_datetime(new_prices["Date"]).dt.normalize())
+    offset, tail = _read_tail(csv_path, new_prices["Date"].min())
+
+    rows = _extend_prices(tail, new_prices)
+    _write_tail(csv_path, offset, rows)
+
+    return rows
+
+
+def _upsert_output(out_path, start, sector_partials, ticker, variant, new_prices,
+                   min_headlines, prefix_emb):
+    """
+    Rewrites one v1-v4 file from the last row before start onwards:
+    new price rows are appended and the sector columns of those rows are recomputed.
+    CSV files are rewritten from that row only, Parquet/Arrow partitions as a whole.
+    """
+    out_path = Path(out_path)
+
+    if out_path.suffix == ".csv":
+        offset, tail = _read_tail(out_path, start)
+    else:
+        table = read_frame(out_path)
+        table["Date"] = pd.to_datetime(table["Date"])
+        before = np.flatnonzero(table["Date"].to_numpy(dtype="datetime64[ns]") < np.datetime64(pd.Timestamp(start), "ns"))
+        first = before[-1] if len(before) else 0
+        head, tail = table.iloc[:first], table.iloc[first:].reset_index(drop=True)
+
+    columns = list(tail.columns)
+
+    if len(tail):
+        sector_partials = select_dates(sector_partials, sector_partials.dates >= tail["Date"].min().to_datetime64())
+    sector = variant_frame(sector_partials, ticker, variant, min_headlines, prefix_emb)
+
+    price_cols = [c for c in columns if c == "Date" or c not in sector.columns]
+    prices = tail[price_cols]
+    if new_prices is not None:
+        prices = _extend_prices(prices, new_prices)
+
+    rows = prices.merge(sector, on="Date", how="left")[columns]
+
+    if out_path.suffix == ".csv":
+        _write_tail(out_path, offset, rows)
+    else:
+        fmt = next(name for name, suffix in FORMATS.items() if suffix == out_path.suffix)
+        write_frame(pd.concat([head, rows], ignore_index=True), out_path, fmt)
+
+    return rows
+
+
+def update_sector_datasets(news_df: pd.DataFrame, new_prices: dict | None = None, out_dir=OUT_DIR,
+                           variants=VARIANTS, min_headlines=1, prefix_emb: bool = True,
+                           state_dir: Path = STATE_DIR, embedding_store=None, fmt: str = "parquet") -> list:
+    """
+    Incremental update of the v1-v4 files written by write_sector_datasets (same fmt).
+
+    news_df    - new headlines (see prepare_headlines), rows that were already ingested are skipped,
+    new_prices - {ticker: DataFrame with 'Date' and 'Price'} of new trading days.
+
+    Only the dates touched by the new rows are recomputed: the news dates for v1/v2,
+    their next trading days for v3/v4 (so weekend news updates the Monday row,
+    also when that Monday is after the last known date: the calendar is loaded with a margin),
+    plus the new price dates. Each file is rewritten from the last unchanged row onwards,
+    which also refreshes Sign_next_day of the previous last row.
+    Returns the paths of the updated files.
+    """
+
+    new_prices = new_prices or {}
+    total, new = ingest_headlines(news_df, state_dir, embedding_store)
+
+    all_dates = np.concatenate([total.dates] + [
+        pd.to_datetime(p["Date"]).dt.normalize().to_numpy(dtype="datetime64[ns]") for p in new_prices.values()
+    ])
+    if len(all_dates) == 0:
+        return []
+    calendar = TradingCalendar.load(all_dates.min(), all_dates.max())
+
+    new_trading_dates = calendar.next_trading_date(new.dates)
+    trading = remap_dates(total, calendar.next_trading_date(total.dates))
+
+    paths = []
+    for k, ticker in enumerate(total.sectors):
+        prices = new_prices.get(ticker)
+        price_start = [pd.to_datetime(prices["Date"]).min().normalize().to_datetime64()] if prices is not None and len(prices) else []
+
+        for variant in variants:
+            out_path = dataset_path(out_dir, ticker, variant, fmt)
+            if not out_path.exists():
+                continue
+
+            touched = new.dates if variant in ("v1", "v2") else new_trading_dates
+            touched = list(touched[(new.rows[k] > 0) & ~np.isnat(touched)]) + price_start
+            if not touched:
+                continue
+            partials = total if variant in ("v1", "v2") else trading
+
+            _upsert_output(out_path, min(touched), partials, ticker, variant, prices, min_headlines, prefix_emb)
+            paths.append(out_path)
+
+    return paths
@@ -0,0 +1,271 @@
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+import cProfile
+import functools
+import json
+import os
+import time
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+LOG_PATH = Path("../data/preprocessed/cache/stage_log.jsonl")
+PROFILE_DIR = Path("../data/preprocessed/cache/profiles")
+
+# set by enable(), also passed to worker processes through the environment
+ENV_LOG = "STAGE_LOG"
+ENV_PROFILE = "STAGE_PROFILE"
+
+_state = {"log_path": None, "profile": None, "profile_dir": PROFILE_DIR}
+_active = []  # records of the stages currently running in this process (outermost first)
+
+
+def _proc_io():
+    """
+    (bytes read, bytes written) by this process so far, from /proc/self/io (Linux only)
+    """
+    try:
+        with open("/proc/self/io") as f:
+            io = dict(line.split(": ") for line in f.read().splitlines())
+        return int(io["rchar"]), int(io["wchar"])
+    except OSError:
+        return None
+
+
+def _rss_mb():
+    """
+    (current RSS, peak RSS) in MB from /proc/self/status,
+    falls back to getrusage (peak only) on other POSIX systems and to (None, None) on Windows
+    """
+    try:
+        with open("/proc/self/status") as f:
+            status = dict(line.split(":", 1) for line in f.read().splitlines() if ":" in line)
+        return int(status["VmRSS"].split()[0]) / 1024, int(status["VmHWM"].split()[0]) / 1024
+    except (OSError, KeyError):
+        return None, peak_rss_mb()
+
+
+def peak_rss_mb():
+    """
+    Peak RSS of this process in MB from getrusage, None where the resource module is missing (Windows)
+    """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _children_cpu():
+    """
+    CPU seconds used by finished child processes, None where the resource module is missing (Windows)
+    """
+    if resource is None:
+        return None
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return children.ru_utime + children.ru_stime
+
+
+def _reset_peak_rss():
+    """
+    Resets the peak RSS counter so the next reading is the peak of one stage
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _shape(obj):
+    if isinstance(obj, pd.DataFrame):
+        return obj.shape
+    if isinstance(obj, pd.Series):
+        return len(obj), 1
+    return None
+
+
+def _add_frame(record, side, obj):
+    shape = _shape(obj)
+    if shape is not None:
+        record[f"rows_{side}"] = record.get(f"rows_{side}", 0) + shape[0]
+        record[f"cols_{side}"] = max(record.get(f"cols_{side}", 0), shape[1])
+
+
+def record_output(df):
+    """
+    Counts a frame written to disk as output of the running stage (called by data_io.write_frame)
+    """
+    if _active:
+        _add_frame(_active[-1], "out", df)
+
+
+def record_input(df):
+    """
+    Counts a frame read from disk as input of the running stage and returns it unchanged
+    (called next to the read_csv calls of the instrumented modules and by data_io.read_frame)
+    """
+    if _active:
+        _add_frame(_active[-1], "in", df)
+    return df
+
+
+def _write(record):
+    log_path = Path(_state["log_path"])
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(log_path, "a") as f:
+        f.write(json.dumps(record, default=str) + "\n")
+
+
+def _profile_path(name):
+    directory = Path(_state["profile_dir"])
+    directory.mkdir(parents=True, exist_ok=True)
+    return directory / f"{name}_{os.getpid()}_{datetime.now():%Y%m%d_%H%M%S_%f}.prof"
+
+
+def stage(func):
+    """
+    Decorator for the public preprocessing functions.
+
+    Does nothing unless enable() was called (or STAGE_LOG is set);
+    then every call appends one JSON line to the log with:
+    wall and CPU time (own and of finished child processes), peak and change of RSS,
+    rows/columns of the DataFrames passed in, read (record_input), returned or written (record_output),
+    and bytes read and written by the process during the call.
+    Nested stages are logged too; their peak RSS is measured from the start of the outer stage.
+    """
+
+    name = f"{func.__module__}.{func.__name__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _state["log_path"] is None:
+            return func(*args, **kwargs)
+
+        record = {"stage": name, "pid": os.getpid(), "depth": len(_active),
+                  "start": datetime.now().isoformat(timespec="milliseconds")}
+        for arg in list(args) + list(kwargs.values()):
+            _add_frame(record, "in", arg)
+            if isinstance(arg, Path):
+                record.setdefault("paths", []).append(str(arg))
+
+        if not _active:
+            _reset_peak_rss()
+        rss_before, _ = _rss_mb()
+        io_before = _proc_io()
+        children_before = _children_cpu()
+        cpu_before = time.process_time()
+        wall_before = time.perf_counter()
+
+        _active.append(record)
+        profiler = cProfile.Profile() if _state["profile"] == name else None
+        try:
+            if profiler is not None:
+                result = profiler.runcall(func, *args, **kwargs)
+            else:
+                result = func(*args, **kwargs)
+        finally:
+            _active.pop()
+
+        record["wall_s"] = time.perf_counter() - wall_before
+        record["cpu_s"] = time.process_time() - cpu_before
+        if children_before is not None:
+            record["children_cpu_s"] = _children_cpu() - children_before
+
+        rss_after, peak = _rss_mb()
+        if peak is not None:
+            record["peak_rss_mb"] = peak
+        if rss_before is not None:
+            record["rss_delta_mb"] = rss_after - rss_before
+
+        io_after = _proc_io()
+        if io_before is not None and io_after is not None:
+            record["bytes_read"] = io_after[0] - io_before[0]
+            record["bytes_written"] = io_after[1] - io_before[1]
+
+        if "rows_out" not in record:
+            _add_frame(record, "out", result)
+
+        if profiler is not None:
+            record["profile"] = str(_profile_path(name))
+            profiler.dump_stats(record["profile"])
+
+        _write(record)
+        return result
+
+    return wrapper
+
+
+def enable(log_path: Path = LOG_PATH, profile: str | None = None, profile_dir: Path = PROFILE_DIR):
+    """
+    Turns on stage logging to log_path (JSON lines, appended).
+    profile - name of one stage (e.g. "news_headlines.preprocess_news") to run under cProfile,
+              the .prof files go to profile_dir (open with snakeviz, or flameprof for a flamegraph).
+    Worker processes started afterwards log to the same file.
+    """
+    _state.update(log_path=str(log_path), profile=profile, profile_dir=str(profile_dir))
+    os.environ[ENV_LOG] = str(log_path)
+    if profile:
+        os.environ[ENV_PROFILE] = f"{profile}|{profile_dir}"
+
+
+def disable():
+    _state.update(log_path=None, profile=None)
+    os.environ.pop(ENV_LOG, None)
+    os.environ.pop(ENV_PROFILE, None)
+
+
+@contextmanager
+def instrumented(log_path: Path = LOG_PATH, profile: str | None = None, profile_dir: Path = PROFILE_DIR):
+    enable(log_path, profile, profile_dir)
+    try:
+        yield Path(log_path)
+    finally:
+        disable()
+
+
+def read_log(log_path: Path = LOG_PATH) -> pd.DataFrame:
+    with open(log_path) as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
+
+
+def summarize(log_path: Path = LOG_PATH, top_level_only: bool = False) -> pd.DataFrame:
+    """
+    One row per stage, sorted by total wall time:
+    number of calls, total/mean wall and CPU time, share of the total wall time,
+    max peak RSS, rows in/out and bytes read/written
+    """
+
+    log = read_log(log_path)
+    if top_level_only:
+        log = log[log["depth"] == 0]
+
+    for col in ["rows_in", "rows_out", "bytes_read", "bytes_written", "children_cpu_s", "peak_rss_mb"]:
+        if col not in log.columns:
+            log[col] = float("nan")
+
+    summary = log.groupby("stage").agg(
+        calls=("wall_s", "size"),
+        wall_s=("wall_s", "sum"),
+        mean_wall_s=("wall_s", "mean"),
+        cpu_s=("cpu_s", "sum"),
+        children_cpu_s=("children_cpu_s", "sum"),
+        peak_rss_mb=("peak_rss_mb", "max"),
+        rows_in=("rows_in", "sum"),
+        rows_out=("rows_out", "sum"),
+        mb_read=("bytes_read", lambda b: b.sum() / 2**20),
+        mb_written=("bytes_written", lambda b: b.sum() / 2**20),
+    )
+
+    summary["wall_share"] = summary["wall_s"] / log.loc[log["depth"] == 0, "wall_s"].sum()
+    return summary.sort_values("wall_s", ascending=False)
+
+
+# worker processes (spawned or forked after enable) pick up the settings from the environment
+if os.environ.get(ENV_LOG) and _state["log_path"] is None:
+    _profile, _, _profile_dir = os.environ.get(ENV_PROFILE, "").partition("|")
+    enable(os.environ[ENV_LOG], _profile or None, _profile_dir or PROFILE_DIR)
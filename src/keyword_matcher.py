@@ -0,0 +1,114 @@
+import re
+from collections import deque
+import numpy as np
+
+
+# words, whitespace runs and single punctuation characters,
+# so a keyword can only match on the same word boundaries as r"\b...\b"
+_TOKEN = re.compile(r"\w+|\s+|[^\w\s]")
+
+
+def tokenize(text: str) -> list:
+    """
+    Lowercases the text and splits it into word-boundary tokens,
+    every whitespace run becomes a single " " token
+    """
+    return [" " if tok[0].isspace() else tok for tok in _TOKEN.findall(text.lower())]
+
+
+class KeywordMatcher:
+    """
+    Aho-Corasick automaton over word tokens for a {sector: [keywords]} dictionary.
+
+    All keywords of all sectors are put in one trie, so every headline
+    is tokenized and scanned once, whatever the number of sectors or keywords.
+    A keyword matches when its tokens appear consecutively in the headline,
+    which is the same as a case-insensitive r"\\bkeyword\\b" search.
+    """
+
+    def __init__(self, keywords_dict: dict):
+        self.sectors = list(keywords_dict)
+
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]  # (sector index, keyword) pairs ending in each state
+
+        for s, terms in enumerate(keywords_dict.values()):
+            for text in terms:
+                if text and isinstance(text, str):
+                    self._add(tokenize(text), s, text)
+
+        self._build_failure_links()
+
+    def _add(self, tokens, sector, keyword):
+        state = 0
+        for tok in tokens:
+            nxt = self._goto[state].get(tok)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][tok] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            state = nxt
+
+        if (sector, keyword) not in self._out[state]:
+            self._out[state].append((sector, keyword))
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+
+        while queue:
+            state = queue.popleft()
+            for tok, nxt in self._goto[state].items():
+                queue.append(nxt)
+
+                fail = self._fail[state]
+                while fail and tok not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(tok, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def iter_matches(self, text: str):
+        """
+        Yields (sector index, keyword) for every keyword occurrence in the text
+        """
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+
+        for tok in tokenize(text):
+            while state and tok not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(tok, 0)
+            yield from out[state]
+
+    def count(self, headlines) -> np.ndarray:
+        """
+        (n_headlines, n_sectors) array with the number of keyword matches per sector,
+        missing headlines (None/NaN) count as no match
+        """
+        counts = np.zeros((len(headlines), len(self.sectors)), dtype=np.int32)
+
+        for i, text in enumerate(headlines):
+            if isinstance(text, str):
+                for s, _ in self.iter_matches(text):
+                    counts[i, s] += 1
+
+        return counts
+
+    def matched_keywords(self, headlines) -> list:
+        """
+        For every headline, a list with one list of matched keywords per sector
+        (in order of appearance, without repeats)
+        """
+        result = []
+
+        for text in headlines:
+            found = [[] for _ in self.sectors]
+            if isinstance(text, str):
+                for s, keyword in self.iter_matches(text):
+                    if keyword not in found[s]:
+                        found[s].append(keyword)
+            result.append(found)
+
+        return result
@@ -0,0 +1,327 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import pandas as pd
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from news_headlines import clean_headlines
+from news_store import NewsStore
+from instrumentation import stage
+
+
+SHINGLE_SIZE = 5        # characters per shingle (at most 8, a shingle is packed into one uint64)
+NUM_BANDS = 20
+BAND_ROWS = 4           # 80 MinHash values per headline
+THRESHOLD = 0.6         # estimated Jaccard similarity of the shingle sets to count as the same story
+MIN_COSINE = 0.85       # cosine similarity of the MiniLM embeddings, checked when they are available
+WINDOW_DAYS = 1
+NEIGHBORS = 3           # headlines compared to each one in an LSH bucket (the next ones by date)
+CHUNKSIZE = 100_000
+NO_DAY = np.iinfo(np.int64).min  # day of headlines that are never paired
+
+
+def _mix(x: np.ndarray) -> np.ndarray:
+    """
+    splitmix64 finalizer: a well spread 64-bit hash of uint64 values
+    """
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def _normalize(headlines) -> pd.Series:
+    """
+    Cleaned, lowercased headlines with every run of punctuation and whitespace as one space,
+    padded to at least SHINGLE_SIZE characters
+    """
+    texts = clean_headlines(pd.Series(headlines, dtype=object).fillna("")).str.lower()
+    # object dtype: \W of the pyarrow string dtype (RE2) only knows ASCII letters
+    texts = texts.astype(object).str.replace(r"[\W_]+", " ", regex=True).str.strip()
+    return texts.str.pad(SHINGLE_SIZE, side="right")
+
+
+def shingles(headlines, k: int = SHINGLE_SIZE):
+    """
+    Hashed character k-grams (of the UTF-8 bytes) of every normalized headline.
+    Returns (hashes, starts): the uint64 shingle hashes of all headlines one after another
+    and the position of each headline's first shingle.
+    """
+
+    encoded = [text.encode("utf-8") for text in _normalize(headlines)]
+    lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+    buffer = np.frombuffer(b"".join(encoded) + b"\0" * k, dtype=np.uint8).astype(np.uint64)
+
+    # k consecutive bytes packed into one integer, for every byte position
+    packed = np.zeros(len(buffer) - k, dtype=np.uint64)
+    for i in range(k):
+        packed |= buffer[i: len(buffer) - k + i] << np.uint64(8 * i)
+
+    ends = np.cumsum(lengths)
+    n_shingles = np.maximum(lengths - k + 1, 0)
+    first = np.repeat(ends - lengths, n_shingles)
+    offsets = np.arange(n_shingles.sum()) - np.repeat(np.cumsum(n_shingles) - n_shingles, n_shingles)
+
+    return _mix(packed[first + offsets]), np.r_[0, np.cumsum(n_shingles)[:-1]]
+
+
+def _chunk_signatures(headlines, a, b, k):
+    hashes, starts = shingles(headlines, k)
+    signatures = np.empty((len(starts), len(a)), dtype=np.uint32)
+
+    permuted = np.empty_like(hashes)
+    for j in range(len(a)):
+        np.multiply(hashes, a[j], out=permuted)
+        permuted += b[j]
+        permuted >>= np.uint64(32)
+        signatures[:, j] = np.minimum.reduceat(permuted, starts)
+
+    return signatures
+
+
+def minhash_signatures(headlines, num_perm: int = NUM_BANDS * BAND_ROWS, k: int = SHINGLE_SIZE,
+                       seed: int = 0, chunksize: int = CHUNKSIZE, n_jobs: int = 1) -> np.ndarray:
+    """
+    (n_headlines, num_perm) uint32 MinHash signatures of the shingle sets.
+    Each permutation is a multiply-shift hash (a * h + b, top 32 bits) of the shingle hash,
+    the minimum is taken per headline with np.minimum.reduceat.
+    Computed chunksize headlines at a time, in n_jobs worker processes if n_jobs > 1.
+    """
+
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2**63, num_perm, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 2**63, num_perm, dtype=np.uint64)
+
+    headlines = list(headlines)
+    chunks = [headlines[start: start + chunksize] for start in range(0, len(headlines), chunksize)]
+
+    if n_jobs > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            blocks = list(pool.map(_chunk_signatures, chunks, repeat(a), repeat(b), repeat(k)))
+    else:
+        blocks = [_chunk_signatures(chunk, a, b, k) for chunk in chunks]
+
+    return np.vstack(blocks) if blocks else np.zeros((0, num_perm), dtype=np.uint32)
+
+
+def candidate_pairs(signatures, days, bands: int = NUM_BANDS, rows: int = BAND_ROWS,
+                    window_days: int = WINDOW_DAYS, neighbors: int = NEIGHBORS):
+    """
+    Pairs (i, j), i < j, of headlines that share an LSH bucket in at least one band
+    and are at most window_days apart. Each bucket is sorted by date and every headline is paired
+    with the next `neighbors` ones, so the work is O(n log n) per band, whatever the bucket sizes.
+    Headlines with day NO_DAY (missing date or empty headline) are never paired.
+    """
+
+    days = np.asarray(days, dtype=np.int64)
+    valid = np.flatnonzero(days != NO_DAY)
+    pairs = []
+
+    for band in range(bands):
+        block = signatures[valid, band * rows: (band + 1) * rows].astype(np.uint64)
+        key = np.zeros(len(valid), dtype=np.uint64)
+        for col in range(rows):
+            key = _mix(key ^ block[:, col])
+
+        perm = np.lexsort((days[valid], key))
+        order, sorted_key = valid[perm], key[perm]
+
+        for lag in range(1, neighbors + 1):
+            same = (sorted_key[lag:] == sorted_key[:-lag]) & (days[order[lag:]] - days[order[:-lag]] <= window_days)
+            pairs.append(np.column_stack([order[:-lag][same], order[lag:][same]]))
+
+    if not pairs:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    pairs = np.sort(np.vstack(pairs), axis=1)
+    return np.unique(pairs, axis=0)
+
+
+def _jaccard(signatures, pairs, chunksize: int = CHUNKSIZE) -> np.ndarray:
+    """
+    Estimated Jaccard similarity of the pairs: the share of equal MinHash values
+    """
+    out = np.empty(len(pairs))
+    for start in range(0, len(pairs), chunksize):
+        chunk = pairs[start: start + chunksize]
+        out[start: start + len(chunk)] = (signatures[chunk[:, 0]] == signatures[chunk[:, 1]]).mean(axis=1)
+    return out
+
+
+def _cosine(vectors, pairs, chunksize: int = CHUNKSIZE) -> np.ndarray:
+    """
+    Cosine similarity of the embedding pairs; vectors is a (n, dim) matrix or a (matrix, rows) pair
+    (rows of -1 have no vector and get NaN)
+    """
+
+    matrix, rows = vectors if isinstance(vectors, tuple) else (vectors, None)
+    out = np.full(len(pairs), np.nan)
+
+    for start in range(0, len(pairs), chunksize):
+        chunk = pairs[start: start + chunksize]
+        if rows is not None:
+            chunk = np.asarray(rows)[chunk]
+        stored = (chunk >= 0).all(axis=1)
+
+        left = np.asarray(matrix[chunk[stored, 0]], dtype=np.float64)
+        right = np.asarray(matrix[chunk[stored, 1]], dtype=np.float64)
+        norms = np.linalg.norm(left, axis=1) * np.linalg.norm(right, axis=1)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out[start + np.flatnonzero(stored)] = (left * right).sum(axis=1) / norms
+
+    return out
+
+
+def _leader_stories(labels, days, signatures, threshold, window_days: int = WINDOW_DAYS,
+                    vectors=None, min_cosine: float | None = None) -> np.ndarray:
+    """
+    Splits the connected components into stories whose members all match the story's first headline,
+    so headlines that only share a template ("Cramer's lightning round: ...") do not chain into one story.
+    The headlines of a component are walked through by date: each one joins the earliest story
+    whose first headline is at most window_days earlier and has an estimated Jaccard similarity
+    of at least threshold (and a cosine similarity of at least min_cosine with vectors),
+    otherwise it starts a new story.
+    Returns the position of each headline's first headline.
+    """
+
+    order = np.lexsort((np.arange(len(labels)), days, labels))
+    sorted_labels = labels[order]
+
+    starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+    ends = np.r_[starts[1:], len(order)]
+    ids = np.arange(len(labels), dtype=np.int64)
+
+    def matches(leaders, members):
+        pairs = np.column_stack([leaders, members])
+        ok = _jaccard(signatures, pairs) >= threshold
+        if vectors is not None and min_cosine is not None:
+            ok &= _cosine(vectors, pairs) >= min_cosine
+        return ok
+
+    for start, end in zip(starts, ends):
+        if end - start == 1:
+            continue
+        members = order[start:end]
+        first = members[0]
+
+        # most components are one story: every headline matches the first one and is in its window
+        rest = members[1:]
+        if days[rest[-1]] - days[first] <= window_days and matches(np.full(len(rest), first), rest).all():
+            ids[members] = first
+            continue
+
+        leaders = []
+        for member in members:
+            leaders = [leader for leader in leaders if days[member] - days[leader] <= window_days]
+            ok = matches(leaders, np.full(len(leaders), member)) if leaders else np.zeros(0, dtype=bool)
+            if ok.any():
+                ids[member] = leaders[int(np.argmax(ok))]
+            else:
+                leaders.append(member)
+
+    return ids
+
+
+@stage
+def story_ids(headlines, dates, window_days: int = WINDOW_DAYS, threshold: float = THRESHOLD,
+              vectors=None, min_cosine: float | None = MIN_COSINE, bands: int = NUM_BANDS, rows: int = BAND_ROWS,
+              seed: int = 0, n_jobs: int = 1) -> np.ndarray:
+    """
+    Groups near-duplicate headlines (the same story with small wording changes,
+    e.g. syndicated across newspapers) that are at most window_days apart.
+
+    MinHash/LSH over character shingles proposes candidate pairs, which are kept
+    if the estimated Jaccard similarity is at least threshold and, when vectors are given
+    (the MiniLM embeddings, a matrix or a (matrix, rows) pair as in compute_partials),
+    if their cosine similarity is at least min_cosine (None skips that check).
+    Stories are built from the connected components of the kept pairs (see _leader_stories):
+    every headline of a story matches the story's first headline and is at most window_days later.
+
+    Returns an int64 story id per headline: the position of the story's first headline
+    (the earliest, the first one by position on ties), so a headline without duplicates
+    has its own position as id.
+    """
+
+    n = len(headlines)
+    days = pd.to_datetime(pd.Series(dates)).dt.normalize().to_numpy(dtype="datetime64[D]")
+    days = np.where(np.isnat(days), NO_DAY, days.astype(np.int64))
+    days[pd.Series(headlines, dtype=object).fillna("").astype(str).str.strip().to_numpy() == ""] = NO_DAY
+
+    signatures = minhash_signatures(headlines, bands * rows, seed=seed, n_jobs=n_jobs)
+    pairs = candidate_pairs(signatures, days, bands, rows, window_days)
+
+    pairs = pairs[_jaccard(signatures, pairs) >= threshold]
+
+    if vectors is not None and min_cosine is not None:
+        pairs = pairs[_cosine(vectors, pairs) >= min_cosine]
+
+    graph = sparse.csr_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+
+    return _leader_stories(labels, days, signatures, threshold, window_days, vectors, min_cosine)
+
+
+def add_story_ids(df: pd.DataFrame, window_days: int = WINDOW_DAYS, threshold: float = THRESHOLD,
+                  **kwargs) -> pd.DataFrame:
+    """
+    Adds a 'story_id' column (see story_ids) from the 'Headlines' and 'Date' columns,
+    the index label of each story's first headline
+    """
+    ids = story_ids(df["Headlines"].tolist(), df["Date"], window_days, threshold, **kwargs)
+    return df.assign(story_id=df.index.to_numpy()[ids])
+
+
+def drop_near_duplicates(df: pd.DataFrame, window_days: int = WINDOW_DAYS, threshold: float = THRESHOLD,
+                         **kwargs) -> pd.DataFrame:
+    """
+    Keeps only the first headline of every story (the earliest one if df is sorted by Date),
+    like drop_duplicates(subset=["Date", "Headlines"]) in notebook 0 but for near-duplicates.
+    The sector averages and n_<TICKER> of the rows left count stories instead of headlines,
+    with the scores of the first copy only (add_story_ids keeps all copies).
+    """
+    ids = story_ids(df["Headlines"].tolist(), df["Date"], window_days, threshold, **kwargs)
+    return df.iloc[ids == np.arange(len(df))]
+
+
+def _store_story_ids(news_store: NewsStore, window_days, threshold, min_cosine) -> np.ndarray:
+    meta = news_store.meta
+    if not news_store.emb_cols:
+        vectors = None
+    elif news_store.emb_rows is None:
+        vectors = news_store.embeddings
+    else:
+        vectors = (news_store.embeddings, news_store.emb_rows)
+
+    return story_ids(meta["Headlines"].tolist(), meta["Date"], window_days, threshold,
+                     vectors=vectors, min_cosine=min_cosine)
+
+
+def add_store_story_ids(news_store: NewsStore, window_days: int = WINDOW_DAYS, threshold: float = THRESHOLD,
+                        min_cosine: float | None = MIN_COSINE) -> NewsStore:
+    """
+    NewsStore with a 'story_id' column in meta and all headlines kept,
+    for build_sector_datasets(..., count_stories=True): n_<TICKER> counts stories
+    and the averages are taken over stories, each one the average of all its copies.
+    If the store has embeddings, the candidate pairs are also checked on them with min_cosine
+    (None turns that off).
+    """
+    ids = _store_story_ids(news_store, window_days, threshold, min_cosine)
+    meta = news_store.meta.assign(story_id=ids)
+    return NewsStore(meta, news_store.embeddings, news_store.emb_cols, emb_rows=news_store.emb_rows)
+
+
+def dedup_news_store(news_store: NewsStore, window_days: int = WINDOW_DAYS, threshold: float = THRESHOLD,
+                     min_cosine: float | None = MIN_COSINE) -> NewsStore:
+    """
+    NewsStore with only the first headline of every story, so the aggregations built from it
+    (build_sector_datasets, partials_from_store) count stories instead of rows.
+    If the store has embeddings, the candidate pairs are also checked on them with min_cosine
+    (None turns that off).
+    """
+
+    meta = news_store.meta
+    keep = _store_story_ids(news_store, window_days, threshold, min_cosine) == np.arange(len(meta))
+
+    if news_store.emb_rows is None:
+        return NewsStore(meta.loc[keep], news_store.embeddings[keep], news_store.emb_cols)
+    return NewsStore(meta.loc[keep], news_store.embeddings, news_store.emb_cols, emb_rows=news_store.emb_rows[keep])
@@ -1,7 +1,13 @@
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import warnings
 import pandas as pd
-import re
+import numpy as np
 from sector_keywords import sector_keywords
+from keyword_matcher import KeywordMatcher
+from data_io import write_frame
+from instrumentation import stage, record_input
 
 
 RAW_DIR = Path("../data/raw")
@@ -17,43 +23,177 @@ OUT_DIR = Path("../data/preprocessed/headlines")
 OUT_DIR.mkdir(parents=True, exist_ok=True) # to make sure the output folder exists
 
 
-def preprocess_news(csv_path: Path) -> Path:
+# explicit formats tried on the normalized 'Time' values, the best one on a sample is used per file
+TIME_FORMATS = [
+    "%I:%M %p %d %b %Y",    # CNBC:     " 7:51  PM ET Fri, 17 July 2020"
+    "%d-%b-%y",             # Guardian: "18-Jul-20"
+    "%b %d %Y",             # Reuters:  "Jul 18 2020"
+    "%d %b %Y",
+    "%Y-%m-%d",
+    "%Y-%m-%d %H:%M:%S",
+    "%d/%m/%Y",
+]
+_SAMPLE_SIZE = 1000
+
+
+def _normalize_times(times: pd.Series) -> pd.Series:
+    """
+    Removes "ET" and weekday names, shortens month names to three letters
+    ("July", "Sept" -> "Jul", "Sep") and collapses whitespace
+    """
+    return (
+        times.astype(str)
+        .str.replace(r"\bET\b", " ", regex=True)
+        .str.replace(r"(?i)\b(?:mon|tue|wed|thu|fri|sat|sun)[a-z]*\b,?", " ", regex=True)
+        .str.replace(r"(?i)\b(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.?", r"\1", regex=True)
+        .str.replace(r"[\s,]+", " ", regex=True)
+        .str.strip()
+    )
+
+
+@stage
+def parse_news_times(times: pd.Series) -> tuple[pd.Series, dict]:
+    """
+    Parses a 'Time' column into dates (normalized to midnight).
+
+    Each distinct value is parsed once. The format is detected on a sample,
+    all values are parsed with it, values that fail are tried with the other formats
+    in TIME_FORMATS and only what is left goes through the slow format="mixed" parser.
+    Returns the dates (NaT where nothing worked) and a report with
+    the detected format and the number of rows parsed by the fallbacks and left unparsed.
+    """
+
+    codes, uniques = pd.factorize(times)
+    uniques = pd.Series(uniques)
+    normalized = _normalize_times(uniques)
+
+    sample = normalized.iloc[:_SAMPLE_SIZE]
+    hits = [pd.to_datetime(sample, format=f, errors="coerce").notna().sum() for f in TIME_FORMATS]
+    best = TIME_FORMATS[int(np.argmax(hits))] if max(hits, default=0) > 0 else None
+
+    parsed = pd.Series(pd.NaT, index=uniques.index, dtype="datetime64[ns]")
+    if best is not None:
+        parsed[:] = pd.to_datetime(normalized, format=best, errors="coerce")
+
+    for f in [f for f in TIME_FORMATS if f != best]:
+        missing = parsed.isna()
+        if not missing.any():
+            break
+        parsed[missing] = pd.to_datetime(normalized[missing], format=f, errors="coerce")
+
+    explicit = parsed.notna()
+    missing = ~explicit
+    if missing.any():
+        fallback = pd.to_datetime(normalized[missing], errors="coerce", dayfirst=True, format="mixed")
+        # values without a day (e.g. "Jul-18") come back as year 1, they count as unparsed
+        parsed[missing] = fallback.where(fallback.between(pd.Timestamp.min, pd.Timestamp.max))
+
+    dates = pd.Series(parsed.dt.normalize().to_numpy()[codes], index=times.index, dtype="datetime64[ns]")
+    dates[codes < 0] = pd.NaT
+
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    report = {
+        "rows": len(times),
+        "format": best,
+        "missing": int((codes < 0).sum()),
+        "fallback": int(counts[(missing & parsed.notna()).to_numpy()].sum()),
+        "unparsed": int(counts[parsed.isna().to_numpy()].sum()),
+    }
+
+    return dates, report
+
+
+def _read_news(csv_path: Path) -> tuple[pd.DataFrame, dict]:
+    """
+    Reads one headline file, parses its dates and restricts the time period
+    """
+
+    newspaper = csv_path.stem.split("_")[0]
+
+    data = record_input(pd.read_csv(csv_path))
+
+    data["Date"], report = parse_news_times(data["Time"])
+    report["newspaper"] = newspaper
+    if report["unparsed"]:
+        warnings.warn(f"{newspaper}: {report['unparsed']} of {report['rows']} timestamps could not be parsed")
+
+    data = data.sort_values("Date", kind="stable")
+    data = data[(data["Date"] >= START) & (data["Date"] <= END)]
+
+    # keeping only the two main columns, dropping "Time" and "Description" if it exists
+    data = data[["Date", "Headlines"]]
+
+    # adding the newspaper name so when all news are merged, we know the source
+    data["Newspaper"] = newspaper
+
+    return data, report
+
+
+@stage
+def preprocess_news(csv_path: Path, fmt: str = "csv") -> Path:
     """
     Reads in the file with news headlines,
-    parses 'Time' into datetime,
+    parses 'Time' into datetime (see parse_news_times),
     drops 'Description' column if it exists,
     renames columns to ['Date', 'Headline],
     adds a 'Newspaper' column,
     restricts the time period
     and saves the result as <NEWSPAPER>_preprocessed.csv
     in the output directory
+    (or .parquet / .arrow with fmt="parquet" / "arrow")
     """
 
     newspaper = csv_path.stem.split("_")[0]
+    data, _ = _read_news(csv_path)
 
-    data = pd.read_csv(csv_path)
+    out_path = write_frame(data, OUT_DIR / f"{newspaper}_preprocessed.csv", fmt)
 
-    # fixing the time format to make sure it's the same in all the files
-    time_fix = data["Time"]
-    time_fix = time_fix.replace(r"\bET\b", "", regex=True) # remove "ET"
-    time_fix = time_fix.replace(r"(?i)\bMon|Tue|Wed|Thu|Fri|Sat|Sun\b,?", "", regex=True)
+    return out_path
 
-    data["Date"] = pd.to_datetime(time_fix, errors="coerce", dayfirst=True, format="mixed").dt.normalize() # we have to drop the hour from one of the files
-    data = data.sort_values("Date")
-    data = data[(data["Date"] >= START) & (data["Date"] <= END)]
 
-    # keeping only the two main columns, dropping "Time" and "Description" if it exists
-    data = data[["Date", "Headlines"]]
+@stage
+def preprocess_all_news(raw_dir: Path = RAW_DIR, n_jobs: int | None = None,
+                        out_path: Path | None = None, fmt: str = "csv") -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Reads and parses all *_headlines.csv files in raw_dir in parallel (n_jobs processes)
+    and concatenates them, as they finish, into one date-filtered table sorted by Date
+    (same rows as the <NEWSPAPER>_preprocessed.csv files concatenated, without writing them).
+    Optionally saves the merged table to out_path.
 
-    # adding the newspaper name so when all news are merged, we know the source
-    data["Newspaper"] = newspaper 
+    Returns the table and one row per file with its parse report.
+    """
 
-    out_path = OUT_DIR / f"{newspaper}_preprocessed.csv"
-    data.to_csv(out_path, index=False)
+    csv_paths = sorted(Path(raw_dir).glob("*_headlines.csv"))
+    parts, reports = {}, []
 
-    return out_path
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = {pool.submit(_read_news, path): path for path in csv_paths}
+        for future in as_completed(futures):
+            parts[futures[future]], report = future.result()
+            reports.append(report)
+
+    if parts:
+        news_df = pd.concat([parts[path] for path in csv_paths], ignore_index=True)
+    else:
+        news_df = pd.DataFrame(columns=["Date", "Headlines", "Newspaper"])
+    news_df = news_df.sort_values("Date", kind="stable").reset_index(drop=True)
+
+    if out_path is not None:
+        write_frame(news_df, out_path, fmt)
+
+    reports = pd.DataFrame(reports, columns=["newspaper", "rows", "format", "missing", "fallback", "unparsed"])
+
+    return news_df, reports.set_index("newspaper").sort_index()
 
 
+MISSING_KEY = np.uint64(0)  # headline_keys() of a missing headline
+
+# zero-width and non-breaking spaces, as real characters (not \u escapes),
+# so the pattern also works with the pyarrow (RE2) string dtype
+_INVISIBLE = "[\u200b-\u200d\u2060\ufeff\u00a0]"
+
+
+@stage
 def clean_headlines(series: pd.Series) -> pd.Series:
     """
     Cleans our news headlines:
@@ -68,35 +208,82 @@ def clean_headlines(series: pd.Series) -> pd.Series:
     return (
         series.astype(str)
         .str.normalize("NFKC")
-        .str.replace(r"[\u200B-\u200D\u2060\uFEFF\u00A0]", "", regex=True)
+        .str.replace(_INVISIBLE, "", regex=True)
         .str.replace(r"\s+", " ", regex=True)
         .str.strip()
     )
 
 
-def _news_category_finder(keywords_dict):
-    """ 
-    Compiles regex patterns for all sector keywords
+@stage
+def headline_keys(series: pd.Series) -> np.ndarray:
     """
-    patterns = {}
+    Cleans the headlines and returns a 64-bit hash of each one (uint64),
+    used as the key of the score and embedding caches.
+    Missing headlines get MISSING_KEY instead of the hash of "nan".
 
-    for sector, terms in keywords_dict.items():
-        escaped = [re.escape(text) for text in terms if text and isinstance(text, str)]
-        pattern_str = r"(?:\b" + r"\b|\b".join(escaped) + r"\b)"
-        patterns[sector] = re.compile(pattern_str, flags=re.IGNORECASE)
-    
-    return patterns
+    >>> keys = headline_keys(pd.Series(["Oil prices rise", " Oil  prices rise", None]))
+    >>> bool(keys[0] == keys[1]), bool(keys[2] == MISSING_KEY)
+    (True, True)
+    """
+
+    series = pd.Series(series)
+    missing = series.isna().to_numpy()
+    keys = np.full(len(series), MISSING_KEY, dtype=np.uint64)
+
+    cleaned = clean_headlines(series[~missing])
+    keys[~missing] = np.array(
+        [int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little") for text in cleaned],
+        dtype=np.uint64,
+    )
+
+    return keys
 
-_PATTERNS = _news_category_finder(sector_keywords)
+
+_MATCHER = KeywordMatcher(sector_keywords)
+
+
+def _match_chunk(headlines, with_keywords=False):
+    """
+    Counts (and optionally lists) the sector keyword matches for one chunk of headlines
+    """
+    counts = _MATCHER.count(headlines)
+    keywords = _MATCHER.matched_keywords(headlines) if with_keywords else None
+    return counts, keywords
 
 
-def flag_sectors(df: pd.DataFrame) -> pd.DataFrame:
+@stage
+def flag_sectors(df: pd.DataFrame, with_counts: bool = False, with_keywords: bool = False,
+                 n_jobs: int = 1, chunksize: int = 100_000) -> pd.DataFrame:
     """
     Add binary flags (0/1) for each ETF sector
-    if its keywords appear in the headline
+    if its keywords appear in the headline.
+
+    All sectors are matched in a single pass over each headline.
+    Optionally adds:
+    - <SECTOR>_count with the number of keyword matches,
+    - <SECTOR>_keywords with the matched keywords joined by ";".
+    With n_jobs > 1 the headlines are split into chunks of chunksize rows
+    and matched in separate processes (useful for the analyst-ratings corpus).
     """
 
-    for sector, pattern in _PATTERNS.items():
-        df[sector] = df["Headlines"].str.contains(pattern, na=False).astype(int)
-    
+    headlines = df["Headlines"].tolist()
+    chunks = [headlines[i: i + chunksize] for i in range(0, len(headlines), chunksize)]
+
+    if n_jobs > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(_match_chunk, chunks, [with_keywords] * len(chunks)))
+    else:
+        results = [_match_chunk(chunk, with_keywords) for chunk in chunks]
+
+    counts = np.vstack([c for c, _ in results]) if results else np.zeros((0, len(_MATCHER.sectors)), dtype=np.int32)
+
+    for s, sector in enumerate(_MATCHER.sectors):
+        df[sector] = (counts[:, s] > 0).astype(int)
+
+        if with_counts:
+            df[f"{sector}_count"] = counts[:, s]
+
+        if with_keywords:
+            df[f"{sector}_keywords"] = [";".join(found[s]) for _, kw in results for found in kw]
+
     return df
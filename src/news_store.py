@@ -0,0 +1,138 @@
+from pathlib import Path
+import pandas as pd
+import numpy as np
+from sector_keywords import sector_keywords
+from news_headlines import headline_keys
+from instrumentation import record_input
+
+
+SENTIMENT_COLS = ["positive", "neutral", "negative"]
+EMB_PREFIX = "emb_"
+
+
+class NewsStore:
+    """
+    In-memory copy of the headline dataset with sentiment scores and embeddings.
+
+    The CSV is parsed once, then:
+    - 'Date' is normalized to midnight,
+    - sentiment scores are float64, sector flags and 'is_trading_day' are int8,
+    - the emb_* columns are kept out of the DataFrame, in one
+      C-contiguous float32 matrix (one row per headline).
+
+    The same store can be passed to every aggregation function,
+    so the v1-v4 datasets for all tickers are built from a single parse.
+
+    When built from an EmbeddingStore, embeddings is the store's memmap
+    and emb_rows holds the vector row of each headline (-1 if missing),
+    so the vectors are never copied into the table.
+    """
+
+    def __init__(self, meta: pd.DataFrame, embeddings: np.ndarray, emb_cols: list, emb_rows: np.ndarray | None = None):
+        if emb_rows is None:
+            if len(meta) != len(embeddings):
+                raise ValueError(f"meta has {len(meta)} rows but embeddings have {len(embeddings)}")
+            embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        elif len(meta) != len(emb_rows):
+            raise ValueError(f"meta has {len(meta)} rows but emb_rows has {len(emb_rows)}")
+
+        self.meta = meta.reset_index(drop=True)
+        self.embeddings = embeddings
+        self.emb_cols = list(emb_cols)
+        self.emb_rows = None if emb_rows is None else np.asarray(emb_rows, dtype=np.int64)
+
+    @classmethod
+    def from_csv(cls, csv_path: Path) -> "NewsStore":
+        """
+        Reads the headline + embedding CSV once and returns the store
+        """
+
+        header = pd.read_csv(csv_path, nrows=0).columns
+        emb_cols = [c for c in header if c.startswith(EMB_PREFIX)]
+        sectors = [c for c in header if c in sector_keywords]
+
+        dtypes = {c: np.float32 for c in emb_cols}
+        dtypes.update({c: np.float64 for c in SENTIMENT_COLS if c in header})
+
+        data = record_input(pd.read_csv(csv_path, dtype=dtypes))
+
+        embeddings = data[emb_cols].to_numpy(dtype=np.float32)
+        meta = data.drop(columns=emb_cols)
+        del data
+
+        meta["Date"] = pd.to_datetime(meta["Date"]).dt.normalize()
+        for col in sectors + (["is_trading_day"] if "is_trading_day" in meta.columns else []):
+            meta[col] = meta[col].fillna(0).astype(np.int8)
+
+        return cls(meta, embeddings, emb_cols)
+
+    @classmethod
+    def from_embedding_store(cls, csv_path: Path, embedding_store) -> "NewsStore":
+        """
+        Reads a headline CSV without emb_* columns and joins it with an EmbeddingStore,
+        by its 'emb_row' column if present, otherwise by the headline hash
+        """
+
+        meta = record_input(pd.read_csv(csv_path, dtype={c: np.float64 for c in SENTIMENT_COLS}))
+        meta = meta.drop(columns=[c for c in meta.columns if c.startswith(EMB_PREFIX)])
+
+        meta["Date"] = pd.to_datetime(meta["Date"]).dt.normalize()
+        for col in [c for c in meta.columns if c in sector_keywords or c == "is_trading_day"]:
+            meta[col] = meta[col].fillna(0).astype(np.int8)
+
+        if "emb_row" in meta.columns:
+            emb_rows = meta.pop("emb_row").fillna(-1).to_numpy(dtype=np.int64)
+        else:
+            emb_rows = embedding_store.row_ids(headline_keys(meta["Headlines"]))
+
+        return cls(meta, embedding_store.vectors, embedding_store.emb_cols, emb_rows=emb_rows)
+
+    def __len__(self):
+        return len(self.meta)
+
+    @property
+    def sectors(self) -> list:
+        """
+        Sector flag columns (e.g. XLE, XLF) present in the data
+        """
+        return [c for c in self.meta.columns if c in sector_keywords]
+
+    def sector_mask(self, ticker: str) -> np.ndarray:
+        """
+        Boolean mask of the headlines tagged for the given sector
+        """
+        return self.meta[ticker].to_numpy() == 1
+
+    def embedding_matrix(self, mask=None) -> np.ndarray:
+        """
+        Embeddings of the (masked) headlines in table order,
+        rows without a stored vector are NaN
+        """
+        if self.emb_rows is None:
+            return self.embeddings if mask is None else self.embeddings[mask]
+
+        rows = self.emb_rows if mask is None else self.emb_rows[mask]
+        out = np.full((len(rows), len(self.emb_cols)), np.nan, dtype=np.float32)
+        out[rows >= 0] = self.embeddings[rows[rows >= 0]]
+
+        return out
+
+    def frame(self, columns=None, emb_cols=None, mask=None) -> pd.DataFrame:
+        """
+        Returns a DataFrame with the selected metadata columns
+        and (optionally) the selected embedding columns as float64,
+        restricted to the rows where mask is True
+        """
+
+        meta = self.meta if columns is None else self.meta[list(columns)]
+        if mask is not None:
+            meta = meta.loc[mask]
+
+        if not emb_cols:
+            return meta.copy()
+
+        idx = [self.emb_cols.index(c) for c in emb_cols]
+        rows = self.embedding_matrix(mask)
+        emb = pd.DataFrame(rows[:, idx].astype(np.float64), columns=list(emb_cols), index=meta.index)
+
+        return pd.concat([meta, emb], axis=1)
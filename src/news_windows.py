@@ -0,0 +1,153 @@
+from zoneinfo import ZoneInfo
+import pandas as pd
+import numpy as np
+from trading_calendar import TradingCalendar, US_EASTERN
+
+
+# news windows in US Eastern time, as in notebook 12 (add_us_windows)
+INTRADAY_START = 9 * 60 + 30    # 09:30
+INTRADAY_END = 16 * 60          # 16:00
+AFTER_END = 20 * 60             # 20:00
+WINDOWS = np.array(["overnight", "intraday", "after_close"], dtype=object)
+
+SECONDS_PER_DAY = 86_400
+_TIME_STRINGS = np.array([f"{s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}" for s in range(SECONDS_PER_DAY)], dtype=object)
+
+
+def to_epoch_seconds(timestamps) -> np.ndarray:
+    """
+    int64 seconds since 1970-01-01 UTC, from integer epochs (returned as they are),
+    tz-aware datetimes or strings with a UTC offset (naive values are taken as UTC).
+    Missing values become INT64_MIN.
+    """
+    series = timestamps if isinstance(timestamps, pd.Series) else pd.Series(timestamps)
+    if pd.api.types.is_integer_dtype(series.dtype):
+        return series.to_numpy(dtype=np.int64)
+
+    if not pd.api.types.is_datetime64_any_dtype(series.dtype):
+        series = pd.to_datetime(series, utc=True, format="ISO8601")
+    elif series.dt.tz is None:
+        series = series.dt.tz_localize("UTC")
+
+    seconds = series.dt.tz_convert("UTC").dt.tz_localize(None).to_numpy(dtype="datetime64[s]").astype(np.int64)
+    seconds[series.isna().to_numpy()] = np.iinfo(np.int64).min
+
+    return seconds
+
+
+def dst_table(start_year: int, end_year: int, tz: str = US_EASTERN):
+    """
+    UTC offsets of tz between start_year and end_year:
+    (transitions, offsets) - epoch seconds where an offset starts and the offset in seconds,
+    the first entry covers everything before start_year
+    """
+    hours = pd.date_range(f"{start_year}-01-01", f"{end_year + 1}-01-01", freq="h", tz="UTC")
+    local = hours.tz_convert(ZoneInfo(tz))
+    offsets = (local.tz_localize(None) - hours.tz_localize(None)).to_numpy(dtype="timedelta64[s]").astype(np.int64)
+
+    change = np.r_[True, offsets[1:] != offsets[:-1]]
+    transitions = hours.tz_localize(None).to_numpy(dtype="datetime64[s]").astype(np.int64)[change]
+    transitions[0] = np.iinfo(np.int64).min
+
+    return transitions, offsets[change]
+
+
+def local_seconds(epoch, tz: str = US_EASTERN, table=None) -> np.ndarray:
+    """
+    Epoch seconds shifted to local wall-clock seconds with a searchsorted over the DST table
+    """
+    epoch = np.asarray(epoch, dtype=np.int64)
+    valid = epoch != np.iinfo(np.int64).min
+
+    if table is None:
+        years = epoch[valid] // (365.2425 * SECONDS_PER_DAY) + 1970
+        table = dst_table(int(years.min()) - 1 if valid.any() else 1970, int(years.max()) + 1 if valid.any() else 1970, tz)
+    transitions, offsets = table
+
+    return np.where(valid, epoch + offsets[np.searchsorted(transitions, epoch, side="right") - 1], epoch)
+
+
+def news_windows(epoch, tz: str = US_EASTERN, table=None):
+    """
+    Returns (local day as days since epoch, second of the local day, window code),
+    the window code indexes WINDOWS: 0 overnight, 1 intraday (09:30-16:00), 2 after_close (16:00-20:00)
+    """
+    local = local_seconds(epoch, tz, table)
+    day, second = np.divmod(local, SECONDS_PER_DAY)
+    minute = second // 60
+
+    window = np.zeros(len(local), dtype=np.int8)
+    window[(minute >= INTRADAY_START) & (minute < INTRADAY_END)] = 1
+    window[(minute >= INTRADAY_END) & (minute < AFTER_END)] = 2
+
+    return day, second, window
+
+
+def trading_dates(day, window, calendar: TradingCalendar | None = None):
+    """
+    (is_trading_day, trading_date as days since epoch) for every article:
+    intraday and overnight news on a session day stays on that day,
+    everything else goes to the next session (the last session if beyond the calendar)
+    """
+    day = np.asarray(day, dtype=np.int64)
+    if calendar is None:
+        calendar = TradingCalendar.load(pd.Timestamp(day.min() - 7, unit="D"), pd.Timestamp(day.max() + 14, unit="D"))
+
+    sessions = calendar.sessions.astype("datetime64[D]").astype(np.int64)
+
+    pos = np.searchsorted(sessions, day, side="left")
+    is_trading_day = sessions[np.minimum(pos, len(sessions) - 1)] == day
+
+    next_session = sessions[np.minimum(np.searchsorted(sessions, day, side="right"), len(sessions) - 1)]
+    same_day = is_trading_day & (window != 2)
+
+    return is_trading_day, np.where(same_day, day, next_session)
+
+
+def group_sizes(*keys) -> np.ndarray:
+    """
+    Size of the group of every row, groups defined by several key arrays
+    (like groupby(keys).transform("size")): the keys are factorized, combined into one int64
+    and counted with a single sort (np.unique)
+    """
+    combined = np.zeros(len(keys[0]), dtype=np.int64)
+    for key in keys:
+        codes, uniques = pd.factorize(np.asarray(key), use_na_sentinel=False)
+        combined = combined * len(uniques) + codes
+
+    _, inverse, counts = np.unique(combined, return_inverse=True, return_counts=True)
+    return counts[inverse.reshape(-1)]
+
+
+def add_news_features(df: pd.DataFrame, ts_col: str = "date", stock_col: str = "stock", sector_col: str = "sector",
+                      calendar: TradingCalendar | None = None) -> pd.DataFrame:
+    """
+    Adds the separate-stocks news features of notebook 12:
+    'time_et', 'date_et', 'news_window', 'is_trading_day', 'trading_date',
+    'articles_same_stock_day' and 'articles_same_sector_day'.
+
+    Everything is computed on int64 epoch seconds: the US Eastern offset comes from
+    a DST transition table, windows from the minute of the day, trading dates
+    from a searchsorted over the NYSE sessions and the counts from group_sizes.
+    Rows with a missing timestamp are dropped.
+    """
+
+    epoch = to_epoch_seconds(df[ts_col])
+    valid = epoch != np.iinfo(np.int64).min
+    if not valid.all():
+        df, epoch = df.loc[valid], epoch[valid]
+
+    day, second, window = news_windows(epoch)
+    is_trading_day, trading_day = trading_dates(day, window, calendar)
+
+    trading_date = trading_day.astype("datetime64[D]").astype("datetime64[ns]")
+
+    return df.assign(
+        time_et=_TIME_STRINGS[second],
+        date_et=day.astype("datetime64[D]").astype("datetime64[ns]"),
+        news_window=WINDOWS[window],
+        is_trading_day=is_trading_day,
+        trading_date=trading_date,
+        articles_same_stock_day=group_sizes(df[stock_col].to_numpy(), trading_day),
+        articles_same_sector_day=group_sizes(df[sector_col].to_numpy(), trading_day),
+    )
@@ -0,0 +1,232 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from pathlib import Path
+import hashlib
+import json
+import os
+import pandas as pd
+import stock_prices
+import news_headlines
+from news_headlines import preprocess_news, clean_headlines, flag_sectors
+from stock_prices import preprocess_file
+from news_store import NewsStore
+from embedding_store import EmbeddingStore, EMB_DIR
+from finbert_scoring import ScoreCache, CACHE_PATH, score_headlines
+from trading_calendar import TradingCalendar
+from etf_transformations import OUT_DIR
+from sector_aggregation import (
+    VARIANTS, dataset_path, datasets_from_partials, partials_from_store,
+    save_partials, load_partials, write_sector_datasets,
+)
+
+
+CACHE_DIR = Path("../data/preprocessed/cache")
+MANIFEST_PATH = CACHE_DIR / "pipeline_manifest.json"
+HEADLINES_PATH = news_headlines.OUT_DIR / "headlines.csv"
+SCORED_PATH = news_headlines.OUT_DIR / "headlines_scored.csv"
+PARTIALS_PATH = CACHE_DIR / "sector_partials.npz"
+
+
+@dataclass
+class Task:
+    """
+    One pipeline step: func(**kwargs) reads the inputs and writes the outputs.
+    The task is skipped when the content of its inputs and its kwargs
+    are the same as in the last successful run and all outputs exist.
+    func has to be a module-level function so it can run in a worker process.
+    """
+
+    name: str
+    func: object
+    kwargs: dict = field(default_factory=dict)
+    inputs: list = field(default_factory=list)
+    outputs: list = field(default_factory=list)
+    deps: list = field(default_factory=list)
+
+
+def _file_hash(path: Path, known: dict) -> str:
+    """
+    sha256 of a file, reused from the manifest if its size and mtime did not change
+    """
+    stat = path.stat()
+    key = str(path.resolve())
+    cached = known.get(key)
+    if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+        return cached[2]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+
+    known[key] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+    return digest.hexdigest()
+
+
+def _fingerprint(task: Task, manifest: dict) -> str:
+    inputs = {str(p): _file_hash(Path(p), manifest["files"]) for p in task.inputs if Path(p).exists()}
+    payload = {
+        "func": f"{task.func.__module__}.{task.func.__qualname__}",
+        "kwargs": task.kwargs,
+        "inputs": inputs,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _load_manifest(path: Path) -> dict:
+    if Path(path).exists():
+        with open(path) as f:
+            return json.load(f)
+    return {"files": {}, "tasks": {}}
+
+
+def _save_manifest(manifest: dict, path: Path):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def run_pipeline(tasks, n_jobs: int | None = None, manifest_path: Path = MANIFEST_PATH, force: bool = False) -> dict:
+    """
+    Runs the tasks in dependency order, independent tasks in parallel
+    (n_jobs processes, all cores by default), skipping the up-to-date ones.
+    Returns {task name: "ran" or "skipped"}.
+    """
+
+    tasks = {t.name: t for t in tasks}
+    for t in tasks.values():
+        missing = [d for d in t.deps if d not in tasks]
+        if missing:
+            raise ValueError(f"task {t.name!r} depends on unknown tasks {missing}")
+
+    manifest = _load_manifest(manifest_path)
+    status = {}
+    pending = dict(tasks)
+    running = {}
+
+    with ProcessPoolExecutor(max_workers=n_jobs or os.cpu_count()) as pool:
+        while pending or running:
+            ready = [t for t in pending.values() if all(d in status for d in t.deps)]
+
+            for task in ready:
+                del pending[task.name]
+                fingerprint = _fingerprint(task, manifest)
+                up_to_date = manifest["tasks"].get(task.name) == fingerprint and all(Path(p).exists() for p in task.outputs)
+
+                if up_to_date and not force:
+                    status[task.name] = "skipped"
+                else:
+                    running[pool.submit(task.func, **task.kwargs)] = (task, fingerprint)
+
+            if ready and not running:
+                continue  # skipped tasks may have unblocked others
+            if not running:
+                raise ValueError(f"dependency cycle between {sorted(pending)}")
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                task, fingerprint = running.pop(future)
+                future.result()
+
+                manifest["tasks"][task.name] = fingerprint
+                status[task.name] = "ran"
+
+            _save_manifest(manifest, manifest_path)
+
+    _save_manifest(manifest, manifest_path)
+    return status
+
+
+def merge_headlines_stage(paths, out_path):
+    """
+    Concatenates the preprocessed headline files, cleans them,
+    drops duplicates and adds the sector flags (notebook 0)
+    """
+    news_df = pd.concat([pd.read_csv(p) for p in paths], ignore_index=True)
+    news_df["Date"] = pd.to_datetime(news_df["Date"])
+    news_df = news_df.sort_values("Date", kind="stable").reset_index(drop=True)
+
+    news_df["Headlines"] = clean_headlines(news_df["Headlines"])
+    news_df = news_df.drop_duplicates(subset=["Date", "Headlines"]).reset_index(drop=True)
+    news_df = flag_sectors(news_df)
+
+    news_df.to_csv(out_path, index=False)
+
+
+def score_stage(in_path, out_path, cache_path, emb_dir):
+    """
+    Adds the FinBERT scores, the row of each headline in the embedding store
+    and is_trading_day (notebooks 2 and 3), only new headlines go through the models
+    """
+    news_df = pd.read_csv(in_path)
+    news_df = news_df.join(score_headlines(news_df["Headlines"], cache=ScoreCache(cache_path)))
+    news_df["emb_row"] = EmbeddingStore(emb_dir).encode(news_df["Headlines"])
+
+    dates = pd.to_datetime(news_df["Date"]).dt.normalize()
+    news_df["is_trading_day"] = TradingCalendar.load(dates.min(), dates.max()).is_trading_day(dates).astype(int)
+
+    news_df.to_csv(out_path, index=False)
+
+
+def partials_stage(news_path, emb_dir, out_path):
+    news_store = NewsStore.from_embedding_store(news_path, EmbeddingStore(emb_dir))
+    save_partials(partials_from_store(news_store), out_path)
+
+
+def dataset_stage(partials_path, price_path, out_dir, variants, min_headlines, prefix_emb, fmt):
+    datasets = datasets_from_partials(load_partials(partials_path), [price_path], variants, min_headlines, prefix_emb)
+    write_sector_datasets(datasets, out_dir, fmt)
+
+
+def build_tasks(raw_dir: Path = stock_prices.RAW_DIR, out_dir: Path = OUT_DIR, variants=VARIANTS,
+                min_headlines: int = 1, prefix_emb: bool = True, fmt: str = "parquet",
+                emb_dir: Path = EMB_DIR, score_cache: Path = CACHE_PATH) -> list:
+    """
+    The whole src/ chain as tasks:
+    prices:<TICKER> and news:<NEWSPAPER> per raw file -> headlines -> scores
+    -> partials -> dataset:<TICKER> (all v1-v4 variants of one ticker)
+    """
+
+    raw_dir = Path(raw_dir)
+    tasks = []
+    price_paths = {}
+
+    for csv_path in sorted(raw_dir.glob("*_prices.csv")):
+        ticker = csv_path.stem.split("_")[0]
+        price_paths[ticker] = stock_prices.OUT_DIR / f"{ticker}_preprocessed.csv"
+        tasks.append(Task(f"prices:{ticker}", preprocess_file, {"csv_path": csv_path},
+                          inputs=[csv_path], outputs=[price_paths[ticker]]))
+
+    news_paths = []
+    for csv_path in sorted(raw_dir.glob("*_headlines.csv")):
+        newspaper = csv_path.stem.split("_")[0]
+        news_paths.append(news_headlines.OUT_DIR / f"{newspaper}_preprocessed.csv")
+        tasks.append(Task(f"news:{newspaper}", preprocess_news, {"csv_path": csv_path},
+                          inputs=[csv_path], outputs=[news_paths[-1]]))
+
+    emb_files = [Path(emb_dir) / "vectors.npy", Path(emb_dir) / "index.npy"]
+
+    tasks += [
+        Task("headlines", merge_headlines_stage, {"paths": news_paths, "out_path": HEADLINES_PATH},
+             inputs=news_paths, outputs=[HEADLINES_PATH], deps=[t.name for t in tasks if t.name.startswith("news:")]),
+        Task("scores", score_stage,
+             {"in_path": HEADLINES_PATH, "out_path": SCORED_PATH, "cache_path": score_cache, "emb_dir": emb_dir},
+             inputs=[HEADLINES_PATH], outputs=[SCORED_PATH, *emb_files], deps=["headlines"]),
+        Task("partials", partials_stage, {"news_path": SCORED_PATH, "emb_dir": emb_dir, "out_path": PARTIALS_PATH},
+             inputs=[SCORED_PATH, *emb_files], outputs=[PARTIALS_PATH], deps=["scores"]),
+    ]
+
+    for ticker, price_path in price_paths.items():
+        kwargs = {
+            "partials_path": PARTIALS_PATH, "price_path": price_path, "out_dir": out_dir,
+            "variants": list(variants), "min_headlines": min_headlines, "prefix_emb": prefix_emb, "fmt": fmt,
+        }
+        tasks.append(Task(f"dataset:{ticker}", dataset_stage, kwargs,
+                          inputs=[PARTIALS_PATH, price_path],
+                          outputs=[dataset_path(out_dir, ticker, v, fmt) for v in variants],
+                          deps=["partials", f"prices:{ticker}"]))
+
+    return tasks
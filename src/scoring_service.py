@@ -0,0 +1,558 @@
+from collections import OrderedDict, deque
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs
+import argparse
+import asyncio
+import json
+import os
+import time
+import pandas as pd
+import numpy as np
+from sector_keywords import sector_keywords
+from news_headlines import clean_headlines, headline_keys, flag_sectors
+from news_store import SENTIMENT_COLS
+from finbert_scoring import FinbertScorer, ScoreCache, LABELS, CACHE_PATH
+from embedding_store import MODEL_NAME as EMB_MODEL_NAME
+from trading_calendar import TradingCalendar, US_EASTERN
+from sector_aggregation import SectorPartials, sector_frame, save_partials, load_partials
+
+
+SNAPSHOT_PATH = Path("../data/preprocessed/cache/live_partials.npz")
+HOST = "127.0.0.1"
+PORT = 8765
+MAX_BATCH_SIZE = 32
+MAX_WAIT_MS = 5
+SNAPSHOT_EVERY = 60     # seconds
+LATENCY_WINDOW = 10_000  # last requests used for the percentiles
+MAX_NEW_SCORES = 100_000  # newly scored headlines kept in memory between snapshots
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+def load_models(with_embeddings: bool = False, num_threads: int | None = None):
+    """
+    FinBERT (and all-MiniLM-L6-v2 if with_embeddings) from the local Hugging Face cache,
+    with the hub switched to offline mode, so nothing is downloaded.
+    Returns (scorer, embedder), embedder is None without embeddings.
+    """
+    os.environ["HF_HUB_OFFLINE"] = "1"
+    os.environ["TRANSFORMERS_OFFLINE"] = "1"
+
+    scorer = FinbertScorer(num_threads=num_threads, local_files_only=True)
+
+    embedder = None
+    if with_embeddings:
+        from sentence_transformers import SentenceTransformer
+        embedder = SentenceTransformer(EMB_MODEL_NAME, device="cpu", local_files_only=True)
+
+    return scorer, embedder
+
+
+class LiveAggregates:
+    """
+    Running sums and non-NaN counts of the headline features per (sector, trading date),
+    the in-memory counterpart of SectorPartials: to_partials() gives partials
+    whose dates are trading dates (as in v3/v4), so sector_frame builds the same
+    avg_*/n_*/sent_index_* columns as the etf_transformations builders.
+    """
+
+    def __init__(self, sectors, features):
+        self.sectors = list(sectors)
+        self.features = list(features)
+        self._totals = {}  # (sector, trading date) -> [rows, counts, sums]
+
+    def __len__(self):
+        return len(self._totals)
+
+    def add(self, flags, dates, values) -> set:
+        """
+        flags  - (n, n_sectors) 0/1 array, dates - (n,) datetime64 trading dates (NaT rows are skipped),
+        values - (n, n_features) array. Returns the (sector, date) keys that changed.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        dates = np.asarray(dates, dtype="datetime64[ns]")
+        changed = set()
+
+        for i, s in zip(*np.nonzero(np.asarray(flags) == 1)):
+            if np.isnat(dates[i]):
+                continue
+            key = (self.sectors[s], dates[i])
+            total = self._totals.setdefault(key, [0, np.zeros(len(self.features), dtype=np.int64),
+                                                  np.zeros(len(self.features))])
+            present = ~np.isnan(values[i])
+            total[0] += 1
+            total[1] += present
+            total[2] += np.where(present, values[i], 0.0)
+            changed.add(key)
+
+        return changed
+
+    def to_partials(self, sectors=None) -> SectorPartials:
+        sectors = self.sectors if sectors is None else list(sectors)
+        keys = [key for key in self._totals if key[0] in sectors]
+        dates = np.unique(np.array([date for _, date in keys], dtype="datetime64[ns]"))
+
+        shape = (len(sectors), len(dates))
+        rows = np.zeros(shape, dtype=np.int64)
+        counts = np.zeros(shape + (len(self.features),), dtype=np.int64)
+        sums = np.zeros(shape + (len(self.features),))
+
+        for sector, date in keys:
+            k, d = sectors.index(sector), np.searchsorted(dates, date)
+            rows[k, d], counts[k, d], sums[k, d] = self._totals[(sector, date)]
+
+        return SectorPartials(sectors, list(self.features), dates, rows, counts, sums)
+
+    @classmethod
+    def from_partials(cls, partials: SectorPartials) -> "LiveAggregates":
+        aggregates = cls(partials.sectors, partials.features)
+        for k, d in zip(*np.nonzero(partials.rows > 0)):
+            aggregates._totals[(partials.sectors[k], partials.dates[d])] = [
+                int(partials.rows[k, d]), partials.counts[k, d].astype(np.int64), partials.sums[k, d].astype(np.float64),
+            ]
+        return aggregates
+
+    def current(self, sector, date) -> dict:
+        """
+        The sector's averages for one trading date so far (same columns as sector_frame)
+        """
+        _, counts, sums = self._totals[(sector, np.datetime64(date, "ns"))]
+        pos, neu, neg = (self.features.index(c) for c in SENTIMENT_COLS)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = sums / counts
+
+        return {
+            f"avg_positive_{sector}": float(means[pos]),
+            f"avg_neutral_{sector}": float(means[neu]),
+            f"avg_negative_{sector}": float(means[neg]),
+            f"n_{sector}": int(counts[pos]),
+            f"sent_index_{sector}": float(means[pos] - means[neg]),
+        }
+
+    def frame(self, sector) -> pd.DataFrame:
+        """
+        Daily sentiment table of one sector (Date = trading date)
+        """
+        return sector_frame(self.to_partials([sector]), sector)
+
+
+class LatencyMetrics:
+    """
+    Request latencies, batch sizes and model times of the last `window` requests/batches
+    """
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.started = time.monotonic()
+        self.requests = 0
+        self.batches = 0
+        self.latencies = deque(maxlen=window)
+        self.finished = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.model_times = deque(maxlen=window)
+
+    def record_request(self, seconds: float):
+        self.requests += 1
+        self.latencies.append(seconds)
+        self.finished.append(time.monotonic())
+
+    def record_batch(self, size: int, seconds: float):
+        self.batches += 1
+        self.batch_sizes.append(size)
+        self.model_times.append(seconds)
+
+    def summary(self) -> dict:
+        now = time.monotonic()
+        latencies = np.array(self.latencies) * 1000
+        model_times = np.array(self.model_times) * 1000
+        finished = np.array(self.finished)
+
+        def percentile(values, q):
+            return float(np.percentile(values, q)) if len(values) else None
+
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "uptime_s": now - self.started,
+            "throughput_rps": self.requests / max(now - self.started, 1e-9),
+            "throughput_1m_rps": float((finished >= now - 60).sum() / min(60, max(now - self.started, 1e-9))),
+            "latency_p50_ms": percentile(latencies, 50),
+            "latency_p99_ms": percentile(latencies, 99),
+            "latency_mean_ms": float(latencies.mean()) if len(latencies) else None,
+            "model_p50_ms": percentile(model_times, 50),
+            "model_p99_ms": percentile(model_times, 99),
+            "mean_batch_size": float(np.mean(self.batch_sizes)) if self.batch_sizes else None,
+        }
+
+
+class MicroBatcher:
+    """
+    Collects concurrent submissions for up to max_wait_ms (or until max_batch_size items)
+    and hands them to process(items) -> results as one batch
+    """
+
+    def __init__(self, process, max_batch_size: int = MAX_BATCH_SIZE, max_wait_ms: float = MAX_WAIT_MS):
+        self.process = process
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+
+            while len(batch) < self.max_batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                results = await self.process([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+class ScoringService:
+    """
+    Local HTTP service that scores live headlines and keeps the sector sentiment up to date.
+
+    Every headline goes through clean_headlines, FinBERT (scores of headlines seen before
+    come from the ScoreCache), optionally MiniLM, and flag_sectors; it is assigned to its session
+    with TradingCalendar.trading_date (news after the close goes to the next session)
+    and added to the running (sector, trading date) aggregates.
+    Concurrent requests are micro-batched into one model forward pass.
+    The aggregates are saved as a SectorPartials snapshot (save_partials) every snapshot_every
+    seconds and on shutdown, and loaded again at start.
+
+    Endpoints (JSON):
+    POST /score          {"headline": ..., "timestamp": ...} or {"headlines": [...], "timestamps": [...]},
+                         timestamps are ISO strings, naive ones are US Eastern, default now
+    GET  /aggregates     ?sector=XLE[&date=YYYY-MM-DD] - daily table of the sector
+    GET  /metrics        p50/p99 latency, throughput, batch sizes
+    POST /snapshot       saves the aggregates now
+    GET  /health
+    """
+
+    def __init__(self, scorer, embedder=None, calendar: TradingCalendar | None = None,
+                 snapshot_path: Path | None = SNAPSHOT_PATH, score_cache: ScoreCache | None = None,
+                 max_batch_size: int = MAX_BATCH_SIZE, max_wait_ms: float = MAX_WAIT_MS,
+                 snapshot_every: float = SNAPSHOT_EVERY):
+        self.scorer = scorer
+        self.embedder = embedder
+        self.calendar = calendar or TradingCalendar.load()
+        self.snapshot_path = snapshot_path
+        self.score_cache = score_cache
+        self.snapshot_every = snapshot_every
+
+        features = list(SENTIMENT_COLS)
+        if embedder is not None:
+            features += [f"emb_{i}" for i in range(embedder.get_sentence_embedding_dimension())]
+
+        self.aggregates = LiveAggregates(list(sector_keywords), features)
+        if snapshot_path is not None and Path(snapshot_path).exists():
+            saved = load_partials(snapshot_path)
+            if saved.features == features:
+                self.aggregates = LiveAggregates.from_partials(saved)
+
+        self.metrics = LatencyMetrics()
+        self.batcher = MicroBatcher(self._process, max_batch_size, max_wait_ms)
+        self._new_scores = OrderedDict()  # key -> scores, least recently used first
+        self._dirty = False
+        self._server = None
+        self._tasks = []
+
+    def _lookup(self, keys):
+        """
+        (found mask, scores) from the score cache and the headlines this service already scored
+        """
+        if self.score_cache is not None:
+            found, scores = self.score_cache.lookup(keys)
+        else:
+            found, scores = np.zeros(len(keys), dtype=bool), np.empty((len(keys), len(LABELS)), dtype=np.float32)
+
+        for i in np.flatnonzero(~found):
+            cached = self._new_scores.get(int(keys[i]))
+            if cached is not None:
+                self._new_scores.move_to_end(int(keys[i]))
+                scores[i], found[i] = cached, True
+
+        return found, scores
+
+    def _remember(self, keys, scores):
+        """
+        Keeps newly scored headlines for _lookup, at most MAX_NEW_SCORES of them:
+        with a score cache they are all moved into it and saved,
+        without one the least recently used scores are dropped
+        """
+        self._new_scores.update(zip(keys, scores))
+        if len(self._new_scores) <= MAX_NEW_SCORES:
+            return
+
+        if self.score_cache is not None:
+            self._flush_scores()
+        else:
+            while len(self._new_scores) > MAX_NEW_SCORES:
+                self._new_scores.popitem(last=False)
+
+    def _flush_scores(self):
+        """
+        Moves the newly scored headlines into the score cache and saves it
+        """
+        if self.score_cache is not None and self._new_scores:
+            self.score_cache.add(list(self._new_scores), np.array(list(self._new_scores.values())))
+            self.score_cache.save()
+            self._new_scores.clear()
+
+    def _infer(self, texts, embed_texts):
+        """
+        Model part of a batch, run in a worker thread: FinBERT on texts (the distinct unscored
+        headlines) and MiniLM on embed_texts
+        """
+        start = time.perf_counter()
+        scores = self.scorer.predict(texts) if texts else np.zeros((0, len(LABELS)), dtype=np.float32)
+        embeddings = None
+        if self.embedder is not None:
+            embeddings = self.embedder.encode(embed_texts, batch_size=len(embed_texts), show_progress_bar=False,
+                                              convert_to_numpy=True)
+        return scores, embeddings, time.perf_counter() - start
+
+    async def _process(self, items) -> list:
+        texts = clean_headlines(pd.Series([item["headline"] for item in items], dtype=object))
+        trading_dates = self.calendar.trading_date(pd.DatetimeIndex([item["timestamp"] for item in items]))
+        flags = flag_sectors(pd.DataFrame({"Headlines": texts}))[self.aggregates.sectors].to_numpy()
+
+        keys = headline_keys(texts)
+        found, scores = self._lookup(keys)
+        missing = np.flatnonzero(~found)
+        unique_keys, first, inverse = np.unique(keys[missing], return_index=True, return_inverse=True)
+
+        loop = asyncio.get_running_loop()
+        predicted, embeddings, seconds = await loop.run_in_executor(
+            None, self._infer, texts.iloc[missing[first]].tolist(), texts.tolist(),
+        )
+        self.metrics.record_batch(len(items), seconds)
+
+        scores[missing] = predicted[inverse]
+        self._remember(unique_keys.tolist(), predicted)
+
+        values = scores.astype(np.float64)
+        if embeddings is not None:
+            values = np.hstack([values, embeddings])
+
+        self.aggregates.add(flags, trading_dates, values)
+        self._dirty = True
+
+        results = []
+        for i, text in enumerate(texts):
+            sectors = [s for s, flag in zip(self.aggregates.sectors, flags[i]) if flag == 1]
+            date = trading_dates[i]
+            results.append({
+                "headline": text,
+                **{label: float(scores[i, j]) for j, label in enumerate(LABELS)},
+                "finbert_label": LABELS[int(scores[i].argmax())],
+                "sectors": sectors,
+                "trading_date": None if np.isnat(date) else str(date.astype("datetime64[D]")),
+                "aggregates": {} if np.isnat(date) else {s: self.aggregates.current(s, date) for s in sectors},
+            })
+
+        return results
+
+    async def score(self, headline: str, timestamp=None) -> dict:
+        """
+        Scores one headline (batched with the concurrent ones),
+        timestamp - when it was published, naive = US Eastern, default now
+        """
+        start = time.perf_counter()
+        if not isinstance(headline, str):
+            raise TypeError(f"headline has to be a string, got {type(headline).__name__}")
+
+        ts = pd.Timestamp.now(tz="UTC") if timestamp is None else pd.Timestamp(timestamp)
+        if ts.tz is None:
+            ts = ts.tz_localize(US_EASTERN, ambiguous="NaT", nonexistent="shift_forward")
+        ts = pd.NaT if ts is pd.NaT else ts.tz_convert("UTC")
+
+        result = await self.batcher.submit({"headline": headline, "timestamp": ts})
+        self.metrics.record_request(time.perf_counter() - start)
+        return result
+
+    def snapshot(self) -> Path | None:
+        """
+        Saves the aggregates (and the newly scored headlines to the score cache)
+        """
+        self._flush_scores()
+
+        if self.snapshot_path is None:
+            return None
+
+        path = Path(self.snapshot_path)
+        tmp_path = path.with_suffix(".tmp.npz")
+        save_partials(self.aggregates.to_partials(), tmp_path)
+        os.replace(tmp_path, path)
+        self._dirty = False
+
+        return path
+
+    async def _snapshot_loop(self):
+        while True:
+            await asyncio.sleep(self.snapshot_every)
+            if self._dirty:
+                self.snapshot()
+
+    async def _route(self, method, target, body):
+        url = urlsplit(target)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+
+        if url.path == "/score":
+            if method != "POST":
+                return 405, {"error": "use POST"}
+            request = json.loads(body or b"{}")
+            if "headlines" in request:
+                headlines = request["headlines"]
+                timestamps = request.get("timestamps") or [None] * len(headlines)
+                if len(timestamps) != len(headlines):
+                    return 400, {"error": "headlines and timestamps have different lengths"}
+                return 200, list(await asyncio.gather(*[self.score(h, t) for h, t in zip(headlines, timestamps)]))
+            if "headline" not in request:
+                return 400, {"error": "missing 'headline'"}
+            return 200, await self.score(request["headline"], request.get("timestamp"))
+
+        if url.path == "/aggregates":
+            sector = query.get("sector")
+            if sector not in self.aggregates.sectors:
+                return 400, {"error": f"sector has to be one of {self.aggregates.sectors}"}
+            table = self.aggregates.frame(sector)
+            if "date" in query:
+                table = table[table["Date"] == pd.Timestamp(query["date"])]
+            table["Date"] = table["Date"].dt.strftime("%Y-%m-%d")
+            return 200, table.astype(object).where(table.notna(), None).to_dict(orient="records")
+
+        if url.path == "/metrics":
+            return 200, {**self.metrics.summary(), "aggregates": len(self.aggregates)}
+
+        if url.path == "/snapshot":
+            if method != "POST":
+                return 405, {"error": "use POST"}
+            return 200, {"path": str(self.snapshot())}
+
+        if url.path == "/health":
+            return 200, {"status": "ok"}
+
+        return 404, {"error": f"unknown path {url.path}"}
+
+    @staticmethod
+    async def _respond(writer, status, payload):
+        data = json.dumps(payload, default=str).encode()
+        writer.write(
+            f"HTTP/1.1 {status} {_REASONS[status]}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+        )
+        await writer.drain()
+
+    async def _handle(self, reader, writer):
+        """
+        Minimal HTTP/1.1 with keep-alive: one JSON request and response at a time per connection.
+        A malformed request line or Content-Length gets a 400 and closes the connection.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+
+                headers = {}
+                try:
+                    method, target, _ = request_line.decode("latin1").split(" ", 2)
+                    while True:
+                        line = await reader.readline()
+                        if line in (b"\r\n", b"\n", b""):
+                            break
+                        name, _, value = line.decode("latin1").partition(":")
+                        headers[name.strip().lower()] = value.strip()
+                    length = int(headers.get("content-length", 0))
+                    if length < 0:
+                        raise ValueError(f"negative Content-Length {length}")
+                except ValueError as e:
+                    await self._respond(writer, 400, {"error": f"malformed request: {e}"})
+                    break
+                body = await reader.readexactly(length)
+
+                try:
+                    status, payload = await self._route(method, target, body)
+                except (ValueError, KeyError, TypeError) as e:
+                    status, payload = 400, {"error": str(e)}
+                except Exception as e:
+                    status, payload = 500, {"error": repr(e)}
+
+                await self._respond(writer, status, payload)
+
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = HOST, port: int = PORT):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        self._tasks = [asyncio.create_task(self.batcher.run()), asyncio.create_task(self._snapshot_loop())]
+        return self._server
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+        for task in self._tasks:
+            task.cancel()
+        self.snapshot()
+
+    async def serve(self, host: str = HOST, port: int = PORT):
+        await self.start(host, port)
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local live headline scoring service")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--embeddings", action="store_true", help="also aggregate the MiniLM embeddings")
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument("--max-wait-ms", type=float, default=MAX_WAIT_MS)
+    parser.add_argument("--snapshot", type=Path, default=SNAPSHOT_PATH)
+    parser.add_argument("--snapshot-every", type=float, default=SNAPSHOT_EVERY)
+    parser.add_argument("--score-cache", type=Path, default=CACHE_PATH)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    scorer, embedder = load_models(args.embeddings, args.threads)
+    service = ScoringService(
+        scorer, embedder, snapshot_path=args.snapshot, score_cache=ScoreCache(args.score_cache),
+        max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms, snapshot_every=args.snapshot_every,
+    )
+    print(f"serving on http://{args.host}:{args.port}")
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,543 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+from pathlib import Path
+import pandas as pd
+import numpy as np
+from scipy import sparse
+from news_store import NewsStore, SENTIMENT_COLS, EMB_PREFIX
+from sector_keywords import sector_keywords
+from etf_transformations import OUT_DIR
+from trading_calendar import TradingCalendar
+from data_io import write_frame, dataset_path
+
+
+VARIANTS = ("v1", "v2", "v3", "v4")
+BLOCK_ROWS = 65_536  # headlines per block multiplied with the sector indicator
+
+
+@dataclass
+class SectorPartials:
+    """
+    Mergeable per-(sector, date) aggregates of the headline features.
+
+    sums and counts have shape (n_sectors, n_dates, n_features),
+    counts only include non-NaN values (like pandas mean/count),
+    rows is the number of tagged headlines per (sector, date).
+    dates are sorted and unique.
+    """
+
+    sectors: list
+    features: list
+    dates: np.ndarray
+    rows: np.ndarray
+    counts: np.ndarray
+    sums: np.ndarray
+
+
+def _block_sums(indicator, block, rows=None):
+    """
+    Sums and non-NaN counts of one (n_headlines, n_features) block
+    for every row of the sparse indicator matrix.
+
+    The block is read BLOCK_ROWS headlines at a time (block[rows[i]] for headline i if rows is given),
+    so only that many rows are ever converted to float64, not the whole (e.g. float32 embedding) matrix.
+    """
+    indicator = sparse.csc_matrix(indicator)
+    n_groups, n_headlines = indicator.shape
+
+    sums = np.zeros((n_groups, block.shape[1]))
+    counts = np.zeros((n_groups, block.shape[1]))
+
+    for start in range(0, n_headlines, BLOCK_ROWS):
+        stop = min(start + BLOCK_ROWS, n_headlines)
+        part = indicator[:, start:stop]
+        if part.nnz == 0:
+            continue
+
+        values = np.asarray(block[start:stop] if rows is None else block[rows[start:stop]], dtype=np.float64)
+        missing = np.isnan(values)
+
+        if missing.any():
+            sums += part @ np.where(missing, 0.0, values)
+            counts += part @ (~missing).astype(np.float64)
+        else:
+            sums += part @ values
+            counts += np.asarray(part.sum(axis=1))
+
+    return sums, np.rint(counts).astype(np.int64)
+
+
+def _group_sums(n_groups, group, cols, n_cols, block, rows=None, story=None):
+    """
+    Sums and non-NaN counts per group of the block rows cols (one entry per tagged headline).
+
+    With story, the copies of a story within a group are averaged first, column by column
+    over their non-NaN values, and the group adds up these story averages (each story counts once).
+    Only the stories with several copies in a group go through the per-story step.
+    """
+    if story is None:
+        indicator = sparse.csr_matrix((np.ones(len(group)), (group, cols)), shape=(n_groups, n_cols))
+        return _block_sums(indicator, block, rows)
+
+    pairs, pair, copies = np.unique(np.column_stack([group, story]), axis=0,
+                                    return_inverse=True, return_counts=True)
+    pair = pair.reshape(-1)
+    single = copies[pair] == 1
+
+    indicator = sparse.csr_matrix((np.ones(single.sum()), (group[single], cols[single])), shape=(n_groups, n_cols))
+    sums, counts = _block_sums(indicator, block, rows)
+
+    if not single.all():
+        multi_pairs, multi_idx = np.unique(pair[~single], return_inverse=True)
+        story_indicator = sparse.csr_matrix(
+            (np.ones(len(multi_idx)), (multi_idx.reshape(-1), cols[~single])),
+            shape=(len(multi_pairs), n_cols),
+        )
+        story_sums, story_counts = _block_sums(story_indicator, block, rows)
+
+        present = story_counts > 0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            story_means = np.where(present, story_sums / story_counts, 0.0)
+
+        to_group = sparse.csr_matrix(
+            (np.ones(len(multi_pairs)), (pairs[multi_pairs, 0], np.arange(len(multi_pairs)))),
+            shape=(n_groups, len(multi_pairs)),
+        )
+        sums += to_group @ story_means
+        counts += np.rint(to_group @ present.astype(np.float64)).astype(np.int64)
+
+    return sums, counts
+
+
+def compute_partials(keys, flags, blocks, sectors, features, stories=None) -> SectorPartials:
+    """
+    Aggregates all sectors in one pass.
+
+    keys   - datetime64 array with the date of each headline (NaT rows are skipped),
+    flags  - (n_headlines, n_sectors) array of 0/1 sector flags,
+    blocks - list of (n_headlines, n_features_i) value arrays, e.g. sentiment and embeddings,
+             kept separate so the embedding matrix is never concatenated.
+             A block can also be a (matrix, rows) pair, where headline i uses matrix[rows[i]]
+             (rows of -1 are missing), e.g. the EmbeddingStore memmap and NewsStore.emb_rows.
+    stories - optional story id of each headline (near_duplicates.story_ids): the copies of a story
+              on the same (sector, date) are averaged first (over their non-NaN values),
+              so rows and counts are numbers of stories and the averages are averages over stories.
+
+    A sparse (sector, date) x headline indicator matrix is multiplied
+    with every block, so a headline tagged for several sectors is read once.
+    """
+
+    keys = np.asarray(keys, dtype="datetime64[ns]")
+    flags = np.asarray(flags)
+    n_headlines = len(keys)
+
+    valid = np.flatnonzero(~np.isnat(keys))
+    dates, day_idx = np.unique(keys[valid], return_inverse=True)
+    hit_row, hit_sector = np.nonzero(flags[valid] == 1)
+
+    group = hit_sector * len(dates) + day_idx[hit_row]
+    n_groups = len(sectors) * len(dates)
+
+    story = None
+    if stories is None:
+        row_counts = np.bincount(group, minlength=n_groups)
+    else:
+        story = np.asarray(stories)[valid[hit_row]]
+        pairs = np.unique(np.column_stack([group, story]), axis=0)
+        row_counts = np.bincount(pairs[:, 0], minlength=n_groups)
+
+    sums, counts = [], []
+    for block in blocks:
+        if isinstance(block, tuple):
+            matrix, rows = block
+            rows = np.asarray(rows)[valid[hit_row]]
+            stored = rows >= 0
+
+            # only the vectors of tagged headlines are read from the matrix
+            used, col = np.unique(rows[stored], return_inverse=True)
+            block_sums, block_counts = _group_sums(
+                n_groups, group[stored], col.reshape(-1), len(used), matrix, used,
+                None if story is None else story[stored],
+            )
+        else:
+            block_sums, block_counts = _group_sums(n_groups, group, valid[hit_row], n_headlines, block, story=story)
+
+        sums.append(block_sums)
+        counts.append(block_counts)
+
+    shape = (len(sectors), len(dates), len(features))
+
+    return SectorPartials(
+        sectors=list(sectors),
+        features=list(features),
+        dates=dates,
+        rows=row_counts.reshape(shape[:2]),
+        counts=np.hstack(counts).reshape(shape),
+        sums=np.hstack(sums).reshape(shape),
+    )
+
+
+def _reduce_dates(partials, dates) -> SectorPartials:
+    """
+    Sums the partials of all entries that share the same (new) date,
+    entries with NaT are dropped
+    """
+    dates = np.asarray(dates, dtype="datetime64[ns]")
+    keep = ~np.isnat(dates)
+
+    order = np.argsort(dates[keep], kind="stable")
+    sorted_dates = dates[keep][order]
+    new_dates, starts = np.unique(sorted_dates, return_index=True)
+
+    def reduce(arr):
+        arr = arr[:, keep][:, order]
+        if len(new_dates) == 0:
+            return arr[:, :0]
+        return np.add.reduceat(arr, starts, axis=1)
+
+    return SectorPartials(
+        sectors=partials.sectors,
+        features=partials.features,
+        dates=new_dates,
+        rows=reduce(partials.rows),
+        counts=reduce(partials.counts),
+        sums=reduce(partials.sums),
+    )
+
+
+def merge_partials(parts) -> SectorPartials:
+    """
+    Merges partials computed on different sets of headlines
+    (same sectors and features) into one
+    """
+    parts = list(parts)
+    first = parts[0]
+
+    merged = SectorPartials(
+        sectors=first.sectors,
+        features=first.features,
+        dates=np.concatenate([p.dates for p in parts]),
+        rows=np.concatenate([p.rows for p in parts], axis=1),
+        counts=np.concatenate([p.counts for p in parts], axis=1),
+        sums=np.concatenate([p.sums for p in parts], axis=1),
+    )
+
+    return _reduce_dates(merged, merged.dates)
+
+
+def remap_dates(partials, new_dates) -> SectorPartials:
+    """
+    Moves every date's aggregates onto new_dates (aligned with partials.dates,
+    e.g. the next trading day) and merges what lands on the same day,
+    dates mapped to NaT are dropped
+    """
+    return _reduce_dates(partials, new_dates)
+
+
+def partials_from_store(news_store: NewsStore, with_embeddings: bool = True,
+                        count_stories: bool = False) -> SectorPartials:
+    """
+    Per-(sector, Date) partials for every sector flag in the store,
+    with count_stories per story (the 'story_id' column, see near_duplicates.add_story_ids)
+    instead of per headline
+    """
+    sectors = news_store.sectors
+    blocks = [news_store.meta[SENTIMENT_COLS].to_numpy()]
+    features = list(SENTIMENT_COLS)
+
+    if with_embeddings:
+        if news_store.emb_rows is None:
+            blocks.append(news_store.embeddings)
+        else:
+            blocks.append((news_store.embeddings, news_store.emb_rows))
+        features += news_store.emb_cols
+
+    return compute_partials(
+        news_store.meta["Date"].to_numpy(),
+        news_store.meta[sectors].to_numpy(),
+        blocks,
+        sectors,
+        features,
+        news_store.meta["story_id"].to_numpy() if count_stories else None,
+    )
+
+
+def sector_frame(partials, ticker, min_headlines=1, emb_cols=None, emb_names=None) -> pd.DataFrame:
+    """
+    Turns the partials of one sector into the daily table used by the v1-v4 datasets:
+    Date, avg_positive_<T>, avg_neutral_<T>, avg_negative_<T>, n_<T>, sent_index_<T>
+    and the embedding means (renamed to emb_names if given).
+    Days with fewer than min_headlines headlines get NaN averages.
+    """
+
+    k = partials.sectors.index(ticker)
+    present = partials.rows[k] > 0
+
+    sums = partials.sums[k, present]
+    counts = partials.counts[k, present]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+
+    pos, neu, neg = (partials.features.index(c) for c in SENTIMENT_COLS)
+
+    out = pd.DataFrame({
+        "Date": partials.dates[present],
+        f"avg_positive_{ticker}": means[:, pos],
+        f"avg_neutral_{ticker}":  means[:, neu],
+        f"avg_negative_{ticker}": means[:, neg],
+        f"n_{ticker}":            counts[:, pos],
+    })
+    out[f"sent_index_{ticker}"] = out[f"avg_positive_{ticker}"] - out[f"avg_negative_{ticker}"]
+
+    emb_out_cols = []
+    if emb_cols:
+        idx = [partials.features.index(c) for c in emb_cols]
+        emb_out_cols = list(emb_names or emb_cols)
+        out = pd.concat([out, pd.DataFrame(means[:, idx], columns=emb_out_cols)], axis=1)
+
+    if min_headlines > 1:
+        too_few = out[f"n_{ticker}"] < min_headlines
+        out.loc[too_few, [
+            f"avg_positive_{ticker}",
+            f"avg_neutral_{ticker}",
+            f"avg_negative_{ticker}",
+            f"sent_index_{ticker}",
+            *emb_out_cols,
+        ]] = np.nan
+
+    return out
+
+
+def trading_day_partials(daily: SectorPartials) -> SectorPartials:
+    """
+    Rolls the per-Date partials onto the next NYSE session (v3/v4)
+    """
+    if len(daily.dates) == 0:
+        return daily
+    calendar = TradingCalendar.load(daily.dates.min(), daily.dates.max())
+    return remap_dates(daily, calendar.next_trading_date(daily.dates))
+
+
+def variant_frame(partials: SectorPartials, ticker, variant, min_headlines=1, prefix_emb: bool = True,
+                  emb_cols=None) -> pd.DataFrame:
+    """
+    The sector columns of one v1-v4 dataset, one row per date in partials
+    (per-Date partials for v1/v2, next-trading-day partials for v3/v4)
+    """
+
+    all_emb_cols = [c for c in partials.features if c not in SENTIMENT_COLS]
+    if emb_cols is None:
+        emb_cols = all_emb_cols
+
+    if variant == "v1":
+        return sector_frame(partials, ticker, min_headlines)
+
+    if variant == "v2":
+        names = [f"{c}_{ticker}" for c in emb_cols] if prefix_emb else None
+        return sector_frame(partials, ticker, min_headlines, emb_cols, names)
+
+    sector = sector_frame(partials, ticker, min_headlines, all_emb_cols if variant == "v4" else None)
+    sector["is_trading_day"] = 1
+    return sector
+
+
+def datasets_from_partials(daily: SectorPartials, csv_paths, variants=VARIANTS, min_headlines=1,
+                           prefix_emb: bool = True, emb_cols=None) -> dict:
+    """
+    Merges each price file (<TICKER>_preprocessed.csv) with its sector's columns
+    from the per-(sector, Date) partials and returns {ticker: {variant: DataFrame}}
+    """
+
+    if "v3" in variants or "v4" in variants:
+        trading = trading_day_partials(daily)
+
+    datasets = {}
+    for csv_path in csv_paths:
+        ticker = Path(csv_path).stem.split("_")[0]
+
+        df = pd.read_csv(csv_path)
+        df["Date"] = pd.to_datetime(df["Date"]).dt.normalize()
+        df_sorted = df.sort_values("Date")
+
+        out = {}
+        for variant in variants:
+            if variant in ("v1", "v2"):
+                sector = variant_frame(daily, ticker, variant, min_headlines, prefix_emb, emb_cols)
+                out[variant] = df.merge(sector, on="Date", how="left")
+            else:
+                sector = variant_frame(trading, ticker, variant, min_headlines)
+                out[variant] = df_sorted.merge(sector, on="Date", how="left")
+
+        datasets[ticker] = out
+
+    return datasets
+
+
+def build_sector_datasets(news_store: NewsStore, csv_paths, variants=VARIANTS, min_headlines=1,
+                          prefix_emb: bool = True, emb_cols=None, count_stories: bool = False) -> dict:
+    """
+    Builds the v1-v4 datasets of all tickers at once.
+
+    The headlines are aggregated once per (sector, Date) for every sector flag,
+    the next-trading-day (v3/v4) aggregates are derived from those partials,
+    and each price file (<TICKER>_preprocessed.csv) is merged with its sector's columns.
+    Gives the same tables as the four per-ticker functions in etf_transformations.
+    With count_stories the store needs a 'story_id' column and n_<TICKER> counts stories,
+    with each story's copies averaged first (near-duplicates are not counted several times).
+
+    Returns {ticker: {variant: DataFrame}}.
+    """
+
+    with_embeddings = "v2" in variants or "v4" in variants
+    daily = partials_from_store(news_store, with_embeddings=with_embeddings, count_stories=count_stories)
+
+    return datasets_from_partials(daily, csv_paths, variants, min_headlines, prefix_emb, emb_cols)
+
+
+def _chunk_partials(chunk, sectors, emb_cols):
+    """
+    Partials of one chunk of the headline CSV
+    """
+    blocks = [chunk[SENTIMENT_COLS].to_numpy(dtype=np.float64)]
+    if emb_cols:
+        blocks.append(chunk[emb_cols].to_numpy(dtype=np.float32))
+
+    return compute_partials(
+        pd.to_datetime(chunk["Date"]).dt.normalize().to_numpy(),
+        chunk[sectors].fillna(0).to_numpy(),
+        blocks,
+        sectors,
+        list(SENTIMENT_COLS) + list(emb_cols),
+    )
+
+
+def stream_partials(csv_path, with_embeddings: bool = True, chunksize: int = 100_000,
+                    n_jobs: int = 1) -> SectorPartials:
+    """
+    Per-(sector, Date) partials of a headline CSV, read chunksize rows at a time.
+
+    Only one chunk (n_jobs > 1: at most 2 * n_jobs chunks) is held in memory,
+    the partials of each chunk are merged into a running total as soon as they are ready.
+    With n_jobs > 1 the chunk partials are computed in worker processes.
+    """
+
+    header = pd.read_csv(csv_path, nrows=0).columns
+    sectors = [c for c in header if c in sector_keywords]
+    emb_cols = [c for c in header if c.startswith(EMB_PREFIX)] if with_embeddings else []
+
+    dtypes = {c: np.float32 for c in emb_cols}
+    dtypes.update({c: np.float64 for c in SENTIMENT_COLS})
+    reader = pd.read_csv(
+        csv_path,
+        usecols=["Date", *SENTIMENT_COLS, *sectors, *emb_cols],
+        dtype=dtypes,
+        chunksize=chunksize,
+    )
+
+    total = None
+
+    def add(part):
+        nonlocal total
+        total = part if total is None else merge_partials([total, part])
+
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            pending = set()
+            for chunk in reader:
+                pending.add(pool.submit(_chunk_partials, chunk, sectors, emb_cols))
+                if len(pending) >= 2 * n_jobs:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        add(future.result())
+            for future in pending:
+                add(future.result())
+    else:
+        for chunk in reader:
+            add(_chunk_partials(chunk, sectors, emb_cols))
+
+    if total is None:
+        # no rows: same sectors and features, no dates
+        features = list(SENTIMENT_COLS) + list(emb_cols)
+        total = SectorPartials(
+            sectors=sectors,
+            features=features,
+            dates=np.zeros(0, dtype="datetime64[ns]"),
+            rows=np.zeros((len(sectors), 0), dtype=np.int64),
+            counts=np.zeros((len(sectors), 0, len(features)), dtype=np.int64),
+            sums=np.zeros((len(sectors), 0, len(features))),
+        )
+
+    return total
+
+
+def stream_sector_datasets(news_csv, csv_paths, variants=VARIANTS, min_headlines=1, prefix_emb: bool = True,
+                           emb_cols=None, chunksize: int = 100_000, n_jobs: int = 1) -> dict:
+    """
+    Out-of-core version of build_sector_datasets:
+    the headline CSV is never loaded whole, only running sums and counts
+    per (sector, Date) are kept, and the v1-v4 tables are built from them.
+    Gives the same tables as the in-memory path.
+    """
+
+    with_embeddings = "v2" in variants or "v4" in variants
+    daily = stream_partials(news_csv, with_embeddings, chunksize, n_jobs)
+
+    return datasets_from_partials(daily, csv_paths, variants, min_headlines, prefix_emb, emb_cols)
+
+
+def write_sector_datasets(datasets: dict, out_dir=OUT_DIR, fmt: str = "parquet") -> list:
+    """
+    Saves the output of build_sector_datasets, partitioned by ticker and variant
+    (see dataset_path). fmt is "parquet" (default), "arrow" or "csv".
+    """
+    paths = []
+
+    for ticker, variants in datasets.items():
+        for variant, df in variants.items():
+            paths.append(write_frame(df, dataset_path(out_dir, ticker, variant, fmt), fmt))
+
+    return paths
+
+
+def save_partials(partials: SectorPartials, path: Path):
+    """
+    Saves partials as a single .npz file
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez(
+        path,
+        sectors=np.array(partials.sectors),
+        features=np.array(partials.features),
+        dates=partials.dates,
+        rows=partials.rows,
+        counts=partials.counts,
+        sums=partials.sums,
+    )
+
+
+def load_partials(path: Path) -> SectorPartials:
+    with np.load(path) as data:
+        return SectorPartials(
+            sectors=data["sectors"].tolist(),
+            features=data["features"].tolist(),
+            dates=data["dates"],
+            rows=data["rows"],
+            counts=data["counts"],
+            sums=data["sums"],
+        )
+
+
+def select_dates(partials: SectorPartials, mask) -> SectorPartials:
+    """
+    Partials restricted to the dates where mask is True
+    """
+    return SectorPartials(
+        sectors=partials.sectors,
+        features=partials.features,
+        dates=partials.dates[mask],
+        rows=partials.rows[:, mask],
+        counts=partials.counts[:, mask],
+        sums=partials.sums[:, mask],
+    )
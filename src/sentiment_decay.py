@@ -0,0 +1,160 @@
+import pandas as pd
+import numpy as np
+from scipy.signal import lfilter
+from news_store import SENTIMENT_COLS
+from trading_calendar import TradingCalendar
+from sector_aggregation import SectorPartials, sector_frame, remap_dates
+
+
+HALF_LIVES = (1, 3, 5, 10)
+GRIDS = ("trading", "calendar")
+
+
+def decay_factors(half_lives) -> np.ndarray:
+    """
+    Per-step decay of each half-life (in grid steps): 0.5 ** (1 / half_life)
+    """
+    half_lives = np.asarray(half_lives, dtype=np.float64)
+    if (half_lives <= 0).any():
+        raise ValueError(f"half-lives have to be positive, got {half_lives.tolist()}")
+    return 0.5 ** (1 / half_lives)
+
+
+def decayed_sums(values, decay: float, axis: int = 0) -> np.ndarray:
+    """
+    The linear recurrence S_t = decay * S_(t-1) + x_t along axis,
+    computed in one pass (scipy's lfilter)
+    """
+    return lfilter([1.0], [1.0, -decay], np.asarray(values, dtype=np.float64), axis=axis)
+
+
+def select_partials(partials: SectorPartials, sectors=None, features=None) -> SectorPartials:
+    """
+    Partials restricted to some sectors and/or features
+    """
+    sector_idx = [partials.sectors.index(s) for s in sectors] if sectors is not None else slice(None)
+    feature_idx = [partials.features.index(f) for f in features] if features is not None else slice(None)
+
+    return SectorPartials(
+        sectors=list(sectors) if sectors is not None else partials.sectors,
+        features=list(features) if features is not None else partials.features,
+        dates=partials.dates,
+        rows=partials.rows[sector_idx],
+        counts=partials.counts[sector_idx][:, :, feature_idx],
+        sums=partials.sums[sector_idx][:, :, feature_idx],
+    )
+
+
+def grid_partials(daily: SectorPartials, grid: str = "trading", end=None,
+                  calendar: TradingCalendar | None = None) -> SectorPartials:
+    """
+    The per-Date partials placed on a gapless grid of dates, with zeros where there is no news:
+    every calendar day ("calendar"), or every NYSE session with weekend and holiday news
+    rolled forward to the next session as in v3/v4 ("trading").
+    The grid runs from the first news date to end (the last news date by default),
+    it is empty if there is no news.
+    """
+
+    if grid not in GRIDS:
+        raise ValueError(f"grid has to be one of {GRIDS}, got {grid!r}")
+
+    if len(daily.dates) == 0:
+        # no news at all: an empty grid, the sector columns come out as NaN
+        return SectorPartials(daily.sectors, daily.features, daily.dates,
+                              daily.rows.astype(np.float64), daily.counts.astype(np.float64),
+                              daily.sums.astype(np.float64))
+
+    end = np.datetime64(pd.Timestamp(end), "ns") if end is not None else daily.dates.max()
+    end = max(end, daily.dates.max())
+
+    if grid == "calendar":
+        partials = daily
+        dates = np.arange(daily.dates.min(), end + np.timedelta64(1, "D"), np.timedelta64(1, "D"))
+    else:
+        if calendar is None:
+            calendar = TradingCalendar.load(daily.dates.min(), end)
+        partials = remap_dates(daily, calendar.next_trading_date(daily.dates))
+        sessions = calendar.sessions
+        dates = sessions[(sessions >= daily.dates.min()) & (sessions <= end)]
+
+    pos = np.searchsorted(dates, partials.dates)
+    keep = pos < len(dates)
+    pos = pos[keep]
+
+    shape = (len(partials.sectors), len(dates))
+    rows = np.zeros(shape)
+    counts = np.zeros(shape + (len(partials.features),))
+    sums = np.zeros(shape + (len(partials.features),))
+
+    rows[:, pos] = partials.rows[:, keep]
+    counts[:, pos] = partials.counts[:, keep]
+    sums[:, pos] = partials.sums[:, keep]
+
+    return SectorPartials(partials.sectors, partials.features, np.asarray(dates, dtype="datetime64[ns]"),
+                          rows, counts, sums)
+
+
+def decay_partials(daily: SectorPartials, half_lives=HALF_LIVES, grid: str = "trading", end=None,
+                   calendar: TradingCalendar | None = None) -> dict:
+    """
+    Exponentially decayed running totals of the per-Date partials, for several half-lives at once.
+
+    On the grid of grid_partials (half-lives are in grid steps: sessions or calendar days),
+    rows, counts and sums of each (sector, feature) follow S_t = decay * S_(t-1) + x_t,
+    one linear pass over the dates for all sectors and features together.
+    Returns {half_life: SectorPartials} with float rows/counts/sums, which sector_frame
+    turns into count-weighted decayed averages: sum_i w_i * x_i / sum_i w_i over all
+    headlines up to and including each date, w_i = 0.5 ** (age_i / half_life).
+    """
+
+    gridded = grid_partials(daily, grid, end, calendar)
+    decayed = {}
+
+    for half_life, decay in zip(half_lives, decay_factors(half_lives)):
+        decayed[half_life] = SectorPartials(
+            sectors=gridded.sectors,
+            features=gridded.features,
+            dates=gridded.dates,
+            rows=decayed_sums(gridded.rows, decay, axis=1),
+            counts=decayed_sums(gridded.counts, decay, axis=1),
+            sums=decayed_sums(gridded.sums, decay, axis=1),
+        )
+
+    return decayed
+
+
+def decayed_sector_frame(decayed: dict, ticker, emb_cols=None, prefix_emb: bool = True) -> pd.DataFrame:
+    """
+    Daily table of one sector from decay_partials: for every half-life h,
+    avg_positive_<T>_hl<h>, avg_neutral_<T>_hl<h>, avg_negative_<T>_hl<h>, sent_index_<T>_hl<h>,
+    n_<T>_hl<h> (the decayed headline count) and, if emb_cols are given, the decayed embedding means.
+    Dates before the sector's first headline are left out.
+    """
+
+    out = None
+    for half_life, partials in decayed.items():
+        names = [f"{c}_{ticker}" for c in emb_cols] if emb_cols and prefix_emb else None
+        frame = sector_frame(partials, ticker, 1, emb_cols, names)
+        frame = frame.rename(columns={c: f"{c}_hl{half_life:g}" for c in frame.columns if c != "Date"})
+
+        out = frame if out is None else out.merge(frame, on="Date", how="outer")
+
+    return out
+
+
+def add_decayed_sentiment(df, daily: SectorPartials, ticker, half_lives=HALF_LIVES, grid: str = "trading",
+                          emb_cols=None, prefix_emb: bool = True) -> pd.DataFrame:
+    """
+    Adds the decayed sentiment of the ticker's sector to a price table (Date column),
+    e.g. sent_index_XLE_hl5. Unlike the v1/v3 columns these have a value on every date
+    after the sector's first headline, also on days with few or no headlines.
+    """
+
+    features = list(SENTIMENT_COLS) + list(emb_cols or [])
+    partials = select_partials(daily, [ticker], features)
+
+    dates = pd.to_datetime(df["Date"]).dt.normalize()
+    decayed = decay_partials(partials, half_lives, grid, end=dates.max())
+    sector = decayed_sector_frame(decayed, ticker, emb_cols, prefix_emb)
+
+    return df.assign(Date=dates).merge(sector, on="Date", how="left")
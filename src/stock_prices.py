@@ -1,31 +1,264 @@
 from pathlib import Path
+import warnings
 import pandas as pd
 import numpy as np
+from data_io import write_frame
+from instrumentation import stage, record_input
 
 RAW_DIR = Path("../data/raw")
 OUT_DIR = Path("../data/preprocessed/etfs")
 OUT_DIR.mkdir(parents=True, exist_ok=True) # to make sure the output folder exists
 
-def preprocess_file(csv_path: Path) -> Path:
+@stage
+def preprocess_file(csv_path: Path, fmt: str = "csv") -> Path:
     """
     Reads in the file with ticker prices, discards the first two rows,
     renames the columns to "Date" and "Price",
     converts data types, sorts by Date,
     calculates the daily return and its sign,
     and saves the result as <TICKER>_preprocessed.csv
-    in the given output directory.
+    in the given output directory
+    (or .parquet / .arrow with fmt="parquet" / "arrow").
     """
 
     ticker = csv_path.stem.split("_")[0]
 
-    data = pd.read_csv(csv_path, skiprows=2)
+    data = record_input(pd.read_csv(csv_path, skiprows=2))
     data.columns = ["Date", "Price"]
     data["Date"] = pd.to_datetime(data["Date"])
     
     data["Return"] = data["Price"].pct_change()
     data["Sign"] = np.sign(data["Return"])
     
-    out_path = OUT_DIR / f"{ticker}_preprocessed.csv"
-    data.to_csv(out_path, index=False)
+    out_path = write_frame(data, OUT_DIR / f"{ticker}_preprocessed.csv", fmt)
 
     return out_path
+
+
+VOL_WINDOW = 5
+HIGH_VOL_QUANTILE = 0.75
+PANEL_COLUMNS = ["Price", "Return", "Sign", "vol_5", "Return_next_day", "AbsReturn_next_day",
+                 "Sign_next_day", "HighVol_next_day"]
+
+
+def _shift(values, periods):
+    """
+    Shifts a 2-D array along the date axis (like DataFrame.shift), padding with NaN
+    """
+    out = np.full(values.shape, np.nan)
+    if periods > 0:
+        out[periods:] = values[:-periods]
+    else:
+        out[:periods] = values[-periods:]
+    return out
+
+
+def panel_features(prices, vol_window: int = VOL_WINDOW, high_vol_quantile: float = HIGH_VOL_QUANTILE) -> dict:
+    """
+    Computes the price features for every ticker at once on a (n_dates, n_tickers) array:
+    - Return (pct change) and Sign,
+    - vol_5 - mean absolute log return over the last vol_window days,
+    - Return_next_day (log return to the next day), AbsReturn_next_day,
+    - Sign_next_day - Sign of the next day (as in etf_transformations.sign_next_day),
+    - HighVol_next_day - 1 if AbsReturn_next_day is above the ticker's high_vol_quantile, else 0
+      (NaN when the next day is missing).
+    A missing price (NaN) makes the values that depend on it NaN, like the groupby/shift code in the notebooks.
+    Returns {column: (n_dates, n_tickers) float64 array}.
+    """
+
+    prices = np.asarray(prices, dtype=np.float64)
+    prev = _shift(prices, 1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ret = prices / prev - 1
+        log_ret = np.log(prices / prev)
+
+    vol = np.full(prices.shape, np.nan)
+    if len(prices) >= vol_window:
+        windows = np.lib.stride_tricks.sliding_window_view(np.abs(log_ret), vol_window, axis=0)
+        vol[vol_window - 1:] = windows.mean(axis=-1)
+
+    sign = np.sign(ret)
+    ret_next = _shift(log_ret, -1)
+    abs_next = np.abs(ret_next)
+
+    high_vol = np.full(prices.shape, np.nan)
+    has_next = ~np.isnan(abs_next)
+    if has_next.any():
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # tickers without any next-day return
+            tau = np.nanquantile(abs_next, high_vol_quantile, axis=0)
+        high_vol[has_next] = (abs_next > tau)[has_next]
+
+    return {
+        "Price": prices,
+        "Return": ret,
+        "Sign": sign,
+        "vol_5": vol,
+        "Return_next_day": ret_next,
+        "AbsReturn_next_day": abs_next,
+        "Sign_next_day": _shift(sign, -1),
+        "HighVol_next_day": high_vol,
+    }
+
+
+class PricePanel:
+    """
+    Close prices of many tickers aligned on one date axis.
+
+    dates   - sorted datetime64[ns] array (n_dates,),
+    tickers - array of ticker names (n_tickers,),
+    prices  - (n_dates, n_tickers) float64 array, NaN where a ticker has no price.
+
+    All features are computed for every ticker in the same array operations
+    (panel_features) and kept in self.features, update_ticker() recomputes only one column.
+    """
+
+    def __init__(self, dates, tickers, prices, vol_window: int = VOL_WINDOW,
+                 high_vol_quantile: float = HIGH_VOL_QUANTILE):
+        self.dates = np.asarray(dates, dtype="datetime64[ns]")
+        self.tickers = np.asarray(tickers, dtype=object)
+        self.prices = np.asarray(prices, dtype=np.float64)
+        self.vol_window = vol_window
+        self.high_vol_quantile = high_vol_quantile
+
+        if self.prices.shape != (len(self.dates), len(self.tickers)):
+            raise ValueError(f"prices have shape {self.prices.shape}, expected {(len(self.dates), len(self.tickers))}")
+
+        self.features = panel_features(self.prices, vol_window, high_vol_quantile)
+
+    @classmethod
+    def from_wide(cls, wide: pd.DataFrame, **kwargs) -> "PricePanel":
+        """
+        Builds the panel from a date-indexed frame with one column of prices per ticker
+        (e.g. the Yahoo close prices of the separate-stocks approach)
+        """
+        wide = wide.sort_index()
+        dates = pd.to_datetime(wide.index).normalize()
+        return cls(dates.to_numpy(), wide.columns.to_numpy(), wide.to_numpy(dtype=np.float64), **kwargs)
+
+    @classmethod
+    def from_long(cls, long: pd.DataFrame, date_col: str = "Date", ticker_col: str = "Ticker",
+                  price_col: str = "Price", **kwargs) -> "PricePanel":
+        """
+        Builds the panel from a long frame with one row per (date, ticker)
+        """
+        dates, date_codes = np.unique(pd.to_datetime(long[date_col]).dt.normalize().to_numpy(), return_inverse=True)
+        tickers, ticker_codes = np.unique(long[ticker_col].astype(str).to_numpy(), return_inverse=True)
+
+        prices = np.full((len(dates), len(tickers)), np.nan)
+        prices[date_codes, ticker_codes] = long[price_col].to_numpy(dtype=np.float64)
+
+        return cls(dates, tickers, prices, **kwargs)
+
+    @classmethod
+    def from_files(cls, csv_paths, **kwargs) -> "PricePanel":
+        """
+        Reads raw <TICKER>_prices.csv files (the layout read by preprocess_file)
+        and aligns them on the union of their dates
+        """
+        series = []
+        for csv_path in csv_paths:
+            data = record_input(pd.read_csv(csv_path, skiprows=2))
+            data.columns = ["Date", "Price"]
+            series.append(pd.Series(data["Price"].to_numpy(dtype=np.float64),
+                                    index=pd.to_datetime(data["Date"]).dt.normalize(),
+                                    name=Path(csv_path).stem.split("_")[0]))
+
+        return cls.from_wide(pd.concat(series, axis=1), **kwargs)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def to_wide(self, columns=PANEL_COLUMNS) -> pd.DataFrame:
+        """
+        Date-indexed frame with (column, ticker) MultiIndex columns
+        """
+        columns = list(columns)
+        values = np.concatenate([self.features[c] for c in columns], axis=1)
+        header = pd.MultiIndex.from_product([columns, self.tickers], names=[None, "Ticker"])
+
+        return pd.DataFrame(values, index=pd.DatetimeIndex(self.dates, name="Date"), columns=header)
+
+    def to_long(self, columns=PANEL_COLUMNS, dropna: bool = True) -> pd.DataFrame:
+        """
+        One row per (Date, Ticker), sorted by Ticker then Date,
+        rows without a price are dropped unless dropna=False
+        """
+        n_dates, n_tickers = self.prices.shape
+
+        # ticker-major order: transpose so each ticker's history is contiguous
+        out = pd.DataFrame({
+            "Date": np.tile(self.dates, n_tickers),
+            "Ticker": np.repeat(self.tickers, n_dates),
+        })
+        for c in columns:
+            out[c] = self.features[c].T.ravel()
+
+        if dropna:
+            out = out[~np.isnan(self.prices.T.ravel())].reset_index(drop=True)
+
+        return out
+
+    def ticker_frame(self, ticker, columns=PANEL_COLUMNS) -> pd.DataFrame:
+        """
+        The features of one ticker, on the dates where it has a price
+        """
+        j = self._column(ticker)
+        rows = ~np.isnan(self.prices[:, j])
+
+        out = pd.DataFrame({"Date": self.dates[rows]})
+        for c in columns:
+            out[c] = self.features[c][rows, j]
+
+        return out
+
+    def _column(self, ticker) -> int:
+        found = np.flatnonzero(self.tickers == ticker)
+        if len(found) == 0:
+            raise KeyError(f"{ticker!r} is not in the panel")
+        return int(found[0])
+
+    def update_ticker(self, ticker, prices: pd.Series):
+        """
+        Sets (or adds) the prices of one ticker, prices is indexed by date.
+        Existing dates are overwritten and new dates added.
+        Only that ticker's features are recomputed, unless a new date falls
+        before the end of the panel: then every ticker gets a new row and all are recomputed.
+        """
+
+        dates = pd.to_datetime(prices.index).normalize().to_numpy(dtype="datetime64[ns]")
+        values = prices.to_numpy(dtype=np.float64)
+
+        new_dates = np.setdiff1d(dates, self.dates)
+        inserted = len(new_dates) and len(self.dates) and new_dates[0] <= self.dates[-1]
+
+        if len(new_dates):
+            all_dates = np.union1d(self.dates, new_dates)
+            grown = np.full((len(all_dates), len(self.tickers)), np.nan)
+            grown[np.searchsorted(all_dates, self.dates)] = self.prices
+
+            self.dates, self.prices = all_dates, grown
+            if not inserted:
+                n_new = len(new_dates)
+                for c, array in self.features.items():
+                    self.features[c] = np.concatenate([array, np.full((n_new, array.shape[1]), np.nan)])
+
+        if ticker not in set(self.tickers):
+            self.tickers = np.append(self.tickers, np.array([ticker], dtype=object))
+            self.prices = np.concatenate([self.prices, np.full((len(self.dates), 1), np.nan)], axis=1)
+            if not inserted:
+                for c, array in self.features.items():
+                    self.features[c] = np.concatenate([array, np.full((len(self.dates), 1), np.nan)], axis=1)
+
+        j = self._column(ticker)
+        self.prices[np.searchsorted(self.dates, dates), j] = values
+
+        if inserted:
+            self.features = panel_features(self.prices, self.vol_window, self.high_vol_quantile)
+        else:
+            column = panel_features(self.prices[:, [j]], self.vol_window, self.high_vol_quantile)
+            for c, array in column.items():
+                self.features[c][:, j] = array[:, 0]
+
+        return self
@@ -0,0 +1,131 @@
+from pathlib import Path
+import pandas as pd
+import numpy as np
+import pandas_market_calendars as mcal
+
+
+CALENDAR_PATH = Path("../data/preprocessed/cache/nyse_sessions.csv")
+START = pd.Timestamp("2000-01-01")
+END = pd.Timestamp("2030-12-31")
+US_EASTERN = "America/New_York"
+# extra days loaded after the requested end, so weekend and holiday news
+# at the end of a range still finds its next session
+PAD = pd.Timedelta(days=14)
+
+_LOADED = {}
+
+
+class TradingCalendar:
+    """
+    NYSE session index built once and saved locally.
+
+    sessions - sorted session dates (midnight, datetime64[ns]),
+    closes   - market close of each session in UTC (tz-naive datetime64[ns]),
+               so early closes (e.g. the day after Thanksgiving) are handled.
+
+    start, end - the date range the schedule was built for
+               (the first and last session if not given).
+
+    Every mapping is a single searchsorted over one of the two arrays.
+    """
+
+    def __init__(self, sessions, closes, start=None, end=None):
+        self.sessions = np.asarray(sessions, dtype="datetime64[ns]")
+        self.closes = np.asarray(closes, dtype="datetime64[ns]")
+        self.start = pd.Timestamp(start if start is not None else self.sessions[0])
+        self.end = pd.Timestamp(end if end is not None else self.sessions[-1])
+
+    @classmethod
+    def build(cls, start=START, end=END, exchange="NYSE") -> "TradingCalendar":
+        schedule = mcal.get_calendar(exchange).schedule(start_date=start, end_date=end)
+
+        return cls(
+            schedule.index.normalize().to_numpy(),
+            schedule["market_close"].dt.tz_convert("UTC").dt.tz_localize(None).to_numpy(),
+            start,
+            end,
+        )
+
+    @classmethod
+    def load(cls, start=START, end=END, path: Path = CALENDAR_PATH) -> "TradingCalendar":
+        """
+        Returns the calendar covering [start, end + PAD],
+        read from path (or from memory if already loaded in this process).
+        It is rebuilt with pandas_market_calendars only if the saved one is too short,
+        and then always covers at least START..END, so it is built once in practice.
+        """
+        start, end = pd.Timestamp(start), pd.Timestamp(end) + PAD
+        path = Path(path)
+
+        calendar = _LOADED.get(path)
+        if calendar is None and path.exists():
+            saved = pd.read_csv(path, parse_dates=["session", "market_close"])
+            built = pd.read_csv(path.with_suffix(".range.csv"), parse_dates=["start", "end"]) \
+                if path.with_suffix(".range.csv").exists() else None
+            calendar = cls(
+                saved["session"].to_numpy(),
+                saved["market_close"].to_numpy(),
+                None if built is None else built["start"].iloc[0],
+                None if built is None else built["end"].iloc[0],
+            )
+
+        if calendar is None or not calendar.covers(start, end):
+            start, end = min(start, START), max(end, END)
+            if calendar is not None:
+                start, end = min(start, calendar.start), max(end, calendar.end)
+            calendar = cls.build(start, end)
+            calendar.save(path)
+
+        _LOADED[path] = calendar
+        return calendar
+
+    def save(self, path: Path = CALENDAR_PATH):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        pd.DataFrame({"session": self.sessions, "market_close": self.closes}).to_csv(path, index=False)
+        pd.DataFrame({"start": [self.start], "end": [self.end]}).to_csv(path.with_suffix(".range.csv"), index=False)
+
+    def covers(self, start, end) -> bool:
+        """
+        True if the calendar was built for a range that includes [start, end]
+        """
+        return self.start <= pd.Timestamp(start) and self.end >= pd.Timestamp(end)
+
+    def is_trading_day(self, dates) -> np.ndarray:
+        """
+        Boolean array, True where the (normalized) date is a session
+        """
+        dates = pd.DatetimeIndex(dates).normalize().to_numpy(dtype="datetime64[ns]")
+        pos = np.minimum(np.searchsorted(self.sessions, dates), len(self.sessions) - 1)
+
+        return self.sessions[pos] == dates
+
+    def next_trading_date(self, dates) -> np.ndarray:
+        """
+        Maps every date to itself if it is a session, otherwise to the next session
+        (weekend and holiday news rolls forward), NaT beyond the calendar
+        """
+        dates = pd.DatetimeIndex(dates).normalize().to_numpy(dtype="datetime64[ns]")
+
+        return self._take(np.searchsorted(self.sessions, dates, side="left"), dates)
+
+    def trading_date(self, timestamps) -> np.ndarray:
+        """
+        Session that a news timestamp belongs to, based on the session close:
+        anything before a session's close goes to that session,
+        news after the close (after hours, weekends, holidays) to the next one.
+        Naive timestamps are taken as US Eastern time.
+        """
+        ts = pd.DatetimeIndex(timestamps)
+        if ts.tz is None:
+            ts = ts.tz_localize(US_EASTERN, ambiguous="NaT", nonexistent="shift_forward")
+        utc = ts.tz_convert("UTC").tz_localize(None).to_numpy(dtype="datetime64[ns]")
+
+        return self._take(np.searchsorted(self.closes, utc, side="right"), utc)
+
+    def _take(self, pos, values):
+        out = np.full(len(pos), np.datetime64("NaT"), dtype="datetime64[ns]")
+        ok = (pos < len(self.sessions)) & ~np.isnat(values)
+        out[ok] = self.sessions[pos[ok]]
+
+        return out
@@ -1,19 +1,98 @@
 import numpy as np
+import pandas as pd
 
 
-def add_weighted_lag_feature(df, col, weights, new_col_name):
+def _normalise(weights):
     w = np.array(weights, dtype=float)
-    w = w / w.sum() # normalise to sum==1
-    values = df[col].values
+    return w / w.sum() # normalise to sum==1
+
+
+def _weighted_windows(values, w):
+    """
+    Weighted sum over the last len(w) rows for every row of a 2-D array,
+    w[0] weights the oldest row of the window.
+    The first len(w)-1 rows are NaN.
+    """
     n = len(values)
     k = len(w)
+    out = np.full(values.shape, np.nan)
+
+    if n >= k:
+        acc = np.zeros((n - k + 1,) + values.shape[1:])
+        for j, wj in enumerate(w):
+            acc += wj * values[j: n - k + 1 + j]
+        out[k-1:] = acc
+
+    return out
+
+
+def weighted_lag_matrix(values, weights, groups=None):
+    """
+    Computes weighted lag features for all columns and weight vectors at once.
+
+    values  - (n_rows, n_cols) array, rows in time order (within each group),
+    weights - list of weight vectors (each normalised to sum 1),
+    groups  - optional (n_rows,) array of group labels (e.g. stock or ticker),
+              windows never cross group boundaries.
+
+    Returns a float64 array of shape (n_weights, n_rows, n_cols),
+    NaN where a row has fewer than len(w)-1 earlier rows in its group.
+    """
+
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        values = values[:, None]
+    n = len(values)
+
+    if groups is not None:
+        codes = pd.factorize(np.asarray(groups), use_na_sentinel=False)[0]
+        order = np.argsort(codes, kind="stable")
+        values = values[order]
 
-    result = [None] * n
+        sorted_codes = codes[order]
+        starts = np.r_[0, np.flatnonzero(np.diff(sorted_codes)) + 1]
+        pos_in_group = np.arange(n) - np.repeat(starts, np.diff(np.r_[starts, n]))
 
-    for i in range(k-1, n):
-        window = values[i-k+1: i+1]
-        result[i] = np.dot(window, w)
+    result = np.empty((len(weights), n, values.shape[1]))
 
-    
-    df[new_col_name] = result
-    return df
\ No newline at end of file
+    for i, weight in enumerate(weights):
+        w = _normalise(weight)
+        out = _weighted_windows(values, w)
+
+        if groups is not None:
+            out[pos_in_group < len(w) - 1] = np.nan
+            result[i, order] = out
+        else:
+            result[i] = out
+
+    return result
+
+
+def add_weighted_lag_features(df, cols, weights: dict, group_col=None):
+    """
+    Adds a weighted lag feature for every column in cols and every weight vector in weights.
+
+    weights maps a name to a weight vector, the new columns are called <col>_<name>,
+    e.g. weights={"wlag3": [1, 2, 3]} on "sent_index_XLE" gives "sent_index_XLE_wlag3".
+    With group_col the lags are computed separately for each group (per stock or ticker).
+    """
+
+    cols = list(cols)
+    lags = weighted_lag_matrix(
+        df[cols].to_numpy(dtype=np.float64),
+        list(weights.values()),
+        groups=None if group_col is None else df[group_col].to_numpy(),
+    )
+
+    new_cols = {
+        f"{col}_{name}": lags[i, :, j]
+        for i, name in enumerate(weights)
+        for j, col in enumerate(cols)
+    }
+
+    return df.assign(**new_cols)
+
+
+def add_weighted_lag_feature(df, col, weights, new_col_name):
+    df[new_col_name] = weighted_lag_matrix(df[col].to_numpy(dtype=np.float64), [weights])[0, :, 0]
+    return df